@@ -12,6 +12,11 @@
 #define DATA_PIN A4
 #define SERIAL_BAUDRATE 9600
 
+//Set to 1 to send compact binary frames instead of lines of text.
+//The Python side then needs protocol="binary", see FrameDecoder in scale.py
+#define BINARY_PROTOCOL 0
+#define SYNC 0xA5
+
 SoftwareSerial bluetooth(BT_RX, BT_TX);
 
 HX711 scale;
@@ -27,6 +32,33 @@ void startupBlink(){
   }
 }
 
+//CRC-8 with polynomial x^8 + x^2 + x + 1
+byte crc8(const byte *data, byte len){
+  byte crc = 0;
+  for (byte i=0; i<len; i++){
+    crc ^= data[i];
+    for (byte b=0; b<8; b++){
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+//sync byte, 24 bit reading (little endian), sequence number, CRC-8 of the reading and sequence number
+byte frame[6];
+byte sequenceNumber = 0;
+
+void sendFrame(long reading){
+  frame[0] = SYNC;
+  frame[1] = reading & 0xFF;
+  frame[2] = (reading >> 8) & 0xFF;
+  frame[3] = (reading >> 16) & 0xFF;
+  frame[4] = sequenceNumber++;
+  frame[5] = crc8(frame + 1, 4);
+  Serial.write(frame, sizeof(frame));
+  bluetooth.write(frame, sizeof(frame));
+}
+
 void setup() {
   //we just want the most basic thing possible. We can do any necessary conversions in python.
   startupBlink();
@@ -39,6 +71,10 @@ void setup() {
 
 void loop() {
   long reading = scale.read();
+#if BINARY_PROTOCOL
+  sendFrame(reading);
+#else
   Serial.println(reading);
   bluetooth.println(reading);
+#endif
 }
@@ -0,0 +1,315 @@
+"""Reading from every scale in one asyncio event loop, instead of a process per scale.
+
+Each SerialScale or BluetoothScale normally starts its own reader process,
+which is about 35 MB each. With a wall of sensors on a small computer that
+adds up, so instead AsyncSerialScale and AsyncBluetoothScale all share one
+event loop running in a daemon thread, which waits on their non-blocking
+file descriptors. The decoding, sequence number checks and timestamping are
+the same ones the reader processes use, and readings are handed over through
+the same RingBuffer, so read() and stats() work exactly the same.
+
+Select it at startup with scale.ENGINE = "asyncio" (or --engine asyncio).
+This needs a POSIX system, since the loop waits on the serial port's file descriptor.
+"""
+import asyncio
+import os
+import threading
+import time
+
+import bluetooth as bt
+import serial
+
+import scale
+
+
+class Engine(object):
+    """The event loop, running in a daemon thread. There is only ever one, see get()"""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self._run, name="acquisition", daemon=True
+        )
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        """Return the engine, starting it if need be"""
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self, connection):
+        """Start reading from a Connection"""
+        asyncio.run_coroutine_threadsafe(connection.run(), self.loop)
+
+    def call(self, f, *args):
+        """Call f(*args) from the event loop's thread"""
+        self.loop.call_soon_threadsafe(f, *args)
+
+
+class Connection(object):
+    """Reads from one scale in the engine's event loop, like SerialReader and BluetoothReader do in their own processes.
+
+    Subclasses open the link in _open() and return its file descriptor.
+    If RECONNECT is set, a link that drops is reopened the way BluetoothReader does it:
+    with backoff from MIN_BACKOFF to MAX_BACKOFF seconds, a GAP reading halfway
+    through the outage, and giving up after RECONNECT_TIMEOUT seconds (or straight
+    away if the first open fails)."""
+
+    RECV_SIZE = 1024
+    MAX_PACKET_SIZE = 20
+    # in seconds. How long to wait for the first bytes, and then for any more
+    LINK_TIMEOUT = 5
+    READ_TIMEOUT = 1
+    RECONNECT = False
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 10
+    RECONNECT_TIMEOUT = 5 * 60
+
+    def __init__(self, ring, stats, protocol):
+        self.stats = stats
+        self._decoder = scale.makeDecoder(protocol, self.MAX_PACKET_SIZE)
+        self._sender = scale.BlockSender(ring)
+        self._quit = False
+        self._linkDown = False
+        self._arrived = None
+        self._fd = None
+        # set while the link is up
+        self.connected = threading.Event()
+        # set once the connection is over, for good
+        self.done = threading.Event()
+
+    async def run(self):
+        self._arrived = asyncio.Event()
+        # when the link went down, None if it's up (or was never up)
+        lostAt = None
+        backoff = self.MIN_BACKOFF
+        try:
+            while not self._quit:
+                try:
+                    self._fd = await self._open()
+                except (OSError, serial.SerialException, bt.BluetoothError) as e:
+                    print(e)
+                    self._close()
+                    if (
+                        not self.RECONNECT
+                        or lostAt is None
+                        or time.time() - lostAt > self.RECONNECT_TIMEOUT
+                    ):
+                        print("giving up on", self)
+                        break
+                    await self._wait(backoff)
+                    backoff = min(2 * backoff, self.MAX_BACKOFF)
+                    continue
+                backoff = self.MIN_BACKOFF
+                self._connected()
+                if lostAt is not None:
+                    print("reconnected to", self)
+                    self._sender.markGap((lostAt + time.time()) / 2)
+                    self._sender.flush()
+                self.connected.set()
+                await self._stream()
+                self.connected.clear()
+                lostAt = time.time()
+                self._sender.flush()
+                self._close()
+                if not self.RECONNECT:
+                    break
+        finally:
+            self.connected.clear()
+            self._sender.flush()
+            self._close()
+            self.done.set()
+
+    def _connected(self):
+        """Start afresh on a new link"""
+        self._linkDown = False
+        # whatever was half-read from before is garbage now,
+        # and we don't know how many sequence numbers went by
+        self._decoder.clear()
+        self.stats.restart()
+        self._sender.clock.reset()
+
+    async def _stream(self):
+        """Read until we're told to quit or the link goes down"""
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self._fd, self._onReadable)
+        try:
+            timeout = self.LINK_TIMEOUT
+            lastArrival = loop.time()
+            while not self._quit and not self._linkDown:
+                # wake up every so often to flush what the sender is holding
+                if await self._wait(scale.BlockSender.FLUSH_INTERVAL):
+                    lastArrival = loop.time()
+                    timeout = self.READ_TIMEOUT
+                elif loop.time() - lastArrival > timeout:
+                    print("didn't read anything from", self)
+                    break
+                self._sender.add(())
+        finally:
+            loop.remove_reader(self._fd)
+            self._fd = None
+
+    async def _wait(self, seconds):
+        """Wait until bytes arrive, we're told to stop, or seconds go by. Returns whether we didn't time out"""
+        try:
+            await asyncio.wait_for(self._arrived.wait(), seconds)
+        except asyncio.TimeoutError:
+            return False
+        self._arrived.clear()
+        return True
+
+    def _onReadable(self):
+        try:
+            data = os.read(self._fd, self.RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(e)
+            data = b""
+        if not data:
+            # end of file, the link went down
+            self._linkDown = True
+            self._arrived.set()
+            return
+        self._sender.add(*self.stats.count(*self._decoder.decode(data)))
+        self._arrived.set()
+
+    def stop(self):
+        """Only call this from the event loop. Use Engine.call(connection.stop) from anywhere else"""
+        self._quit = True
+        if self._arrived is not None:
+            self._arrived.set()
+
+    async def _open(self):
+        raise NotImplementedError("_open() must be overriden in subclasses")
+
+    def _close(self):
+        raise NotImplementedError("_close() must be overriden in subclasses")
+
+
+class SerialConnection(Connection):
+    def __init__(self, portname, baudrate, ring, stats, protocol):
+        super().__init__(ring, stats, protocol)
+        self.portname = portname
+        self.baudrate = baudrate
+        self._ser = None
+
+    def __str__(self):
+        return self.portname
+
+    async def _open(self):
+        # timeout=0 makes the port non-blocking
+        self._ser = serial.Serial(self.portname, baudrate=self.baudrate, timeout=0)
+        print("successfully opened serial port", self.portname)
+        return self._ser.fileno()
+
+    def setBaudrate(self, newval):
+        self.baudrate = newval
+        if self._ser:
+            self._ser.baudrate = newval
+            # anything half-read at the old baudrate is garbage now
+            self._decoder.clear()
+
+    def _close(self):
+        if self._ser:
+            self._ser.close()
+            self._ser = None
+
+
+class BluetoothConnection(Connection):
+
+    RECONNECT = True
+    PORT = 1
+    MAX_PACKET_SIZE = 10
+    READ_TIMEOUT = 10
+    LINK_TIMEOUT = 10
+
+    def __init__(self, address, ring, stats, protocol):
+        super().__init__(ring, stats, protocol)
+        self.address = address
+        self._sock = None
+
+    def __str__(self):
+        return self.address
+
+    async def _open(self):
+        self._sock = bt.BluetoothSocket(bt.RFCOMM)
+        # connecting blocks for a few seconds, so do it in a worker thread
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._sock.connect, (self.address, self.PORT)
+        )
+        self._sock.setblocking(False)
+        return self._sock.fileno()
+
+    def _close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+
+class AsyncSerialScale(scale.SerialScale):
+    """A SerialScale that is read by the Engine instead of a SerialReader process"""
+
+    def __init__(self, port, baudrate=9600, protocol="ascii"):
+        self.port = port
+        self._baudrate = baudrate
+        self.protocol = protocol
+
+        self._openRing(self.MAX_BUFFERED_READINGS)
+        self.linkStats = scale.LinkStats()
+        self.connection = SerialConnection(
+            port, baudrate, self.ring, self.linkStats, protocol
+        )
+        self.engine = Engine.get()
+        self.engine.start(self.connection)
+
+    def isOpen(self):
+        return not self.connection.done.is_set()
+
+    def close(self):
+        self.engine.call(self.connection.stop)
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, newval):
+        self._baudrate = newval
+        self.engine.call(self.connection.setBaudrate, newval)
+
+
+class AsyncBluetoothScale(scale.BluetoothScale):
+    """A BluetoothScale that is read by the Engine instead of a BluetoothReader process"""
+
+    def __init__(self, address, name, protocol="ascii"):
+        self.address = address
+        self.name = name
+        self.protocol = protocol
+
+        self._openRing(self.MAX_BUFFERED_READINGS)
+        self.linkStats = scale.LinkStats()
+        self.connection = BluetoothConnection(
+            address, self.ring, self.linkStats, protocol
+        )
+        self.engine = Engine.get()
+        self.engine.start(self.connection)
+
+    def isOpen(self):
+        return not self.connection.done.is_set()
+
+    def close(self):
+        self.engine.call(self.connection.stop)
+
+    def isConnected(self):
+        return self.isOpen() and self.connection.connected.is_set()
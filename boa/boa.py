@@ -5,18 +5,22 @@
 Various methods of drawing scrolling plots.
 """
 from __future__ import division
-import csv
-import warnings
+import argparse
 from math import fabs
-from collections import deque
 import signal
+import time
 
-import numpy as np
 from pyqtgraph.Qt import QtCore, QtGui
 import pyqtgraph as pg
 
 import gui
+import latency
+import recording
 import scale
+from calibration import Calibration
+from journal import Journal
+from samples import Downsampler, SampleStore, downSampleReadings
+from session import Session
 
 
 class LoadCellControl(QtCore.QObject):
@@ -24,7 +28,20 @@ class LoadCellControl(QtCore.QObject):
 
     Reads from scale if selected, opens and saves recordings and calibrations"""
 
-    def __init__(self):
+    # everything read from a scale is always written here too, see journal.py
+    JOURNAL_DIRECTORY = "recordings/journal"
+    # in seconds
+    JOURNAL_FSYNC_INTERVAL = 1.0
+    JOURNAL_SEGMENT_DURATION = 60 * 60
+    # in bytes
+    JOURNAL_SEGMENT_SIZE = 32 * 2**20
+    # only real scales are journaled, so the Random Generator and replayed
+    # recordings never get mixed in with real readings
+    JOURNALED_SCALES = (scale.SerialScale, scale.BluetoothScale)
+
+    def __init__(self, extraScales=(), randomGenerator=None):
+        """extraScales are offered along with the scales that are found, eg ReplayScales.
+        randomGenerator is the PhonyScale behind "Random Generator"."""
         super().__init__()
 
         # init our app and gui
@@ -33,17 +50,34 @@ class LoadCellControl(QtCore.QObject):
 
         # set up our instance variables
         self.length = 100000
-        self.data = deque([], self.length)
+        self.data = SampleStore(self.length)
         self.numSamplesLastReading = 0
         self.scales = []
         self.scale = None
+        # the scale's stats() when we last showed them
+        self.lastStats = None
         self.calibration = Calibration()
         self.sampleRate = self.gui.getSampleRate()
         self.baudrate = self.gui.getBaudrate()
-        self.randomGenerator = scale.PhonyScale()
+        # number of decimal places when saving a recording as csv, None for full precision
+        self.csvPrecision = None
+        self.randomGenerator = randomGenerator or scale.PhonyScale()
+        self.extraScales = list(extraScales)
+        # when recording from all scales, every scale is read through this
+        self.session = Session(self.sampleRate, self.length)
+        self.recordAll = False
+        self.journal = Journal(
+            self.JOURNAL_DIRECTORY,
+            self.JOURNAL_FSYNC_INTERVAL,
+            self.JOURNAL_SEGMENT_SIZE,
+            self.JOURNAL_SEGMENT_DURATION,
+        )
+        self.journalDownsampler = Downsampler(1.0 / self.sampleRate)
 
         # set up signals and slots from the GUI
         self.gui.sigScaleChanged.connect(self.useScale)
+        self.gui.sigRecordAllChanged.connect(self.setRecordAll)
+        self.gui.sigCsvPrecisionChanged.connect(self.setCsvPrecision)
         self.gui.sigSampleRateChanged.connect(self.setSampleRate)
         self.gui.sigBaudrateChanged.connect(self.setBaudrate)
 
@@ -59,7 +93,10 @@ class LoadCellControl(QtCore.QObject):
         # Make it so we update the list of available scales every second
         self.scaleUpdateTimer = pg.QtCore.QTimer()
         self.scaleUpdateTimer.timeout.connect(self.updateAvailableScales)
+        self.scaleUpdateTimer.timeout.connect(self.updateLinkStats)
         self.scaleUpdateTimer.start(1000)
+        for s in self.extraScales:
+            self.addScale(s)
 
         # make it so we repaint the GUI every 30th of a second
         # readFromScale() is buffered, so we will still get the full 80Hz samplerate
@@ -72,61 +109,75 @@ class LoadCellControl(QtCore.QObject):
 
         # start up the app!
         self.app.exec_()
+        self.flushJournal()
+        self.journal.close()
 
     def readFromScale(self):
         """Read all of the last readings from the scale, downsample them to our sampleRate, and add them"""
+        stopwatch = latency.Stopwatch()
+        # reading a scale empties it, so if the session reads our scale, take its readings from there
+        raw = self.session.read()
+        readTime = time.time()
         if self.scale:
-            self.addReadings(self.scale.read())
+            if self.scale in raw:
+                times, values = raw[self.scale]
+            else:
+                times, values = self.scale.read()
+                readTime = time.time()
+            arrived = latency.recordRing(getattr(self.scale, "ring", None), readTime)
+            # The journal only gets samples that are final, unlike self.data,
+            # whose last sample can still be merged with the next readings
+            if isinstance(self.scale, self.JOURNALED_SCALES):
+                self.journal.append(*self.journalDownsampler.add(times, values))
+            stopwatch.lap("read")
+            self.addReadings(times, values, stopwatch)
+            if stopwatch.enabled and len(times):
+                self._timeRepaint(stopwatch, arrived)
+
+    def _timeRepaint(self, stopwatch, arrived):
+        """Record the time until the event loop gets back to us, by when the plot has been repainted.
+
+        arrived is when the newest readings arrived at the reader, or None if we don't know"""
+
+        def f():
+            stopwatch.lap("repaint")
+            if arrived is not None:
+                latency.record("end to end", time.time() - arrived)
+
+        QtCore.QTimer.singleShot(0, f)
+
+    def flushJournal(self):
+        """Write the sample the journal is holding back, eg before the sample rate or scale changes"""
+        self.journal.append(*self.journalDownsampler.flush())
 
     def clear(self):
         self.numSamplesLastReading = 0
         self.data.clear()
+        self.session.clear()
         self.gui.clear()
 
-    @staticmethod
-    def _round(x, base, prec=100):
-        """Round to an arbitrary base (eg multiples of 3) to a precision of a certain number of decimal places"""
-        return round(base * round(float(x) / base), prec)
-
-    @classmethod
-    def _downSampleReadings(cls, readings, sampleInterval):
-        """Takes a list of of form [(time, val), ...] and round all times to multiples of sampleRate,
-        averaging all readings from the same time. Returns list of form [(roundedtime, val, numsamplesperroundedtimereading),...]
-
-        ex: [(1, 4), (3, 6), (4, 8)] -> [(0, 4, 1), (5, 7, 2)] for sampleRate = 5"""
-        # make a dict holding mapping from rounded times to a list of values for that roundedTime
-        d = {}
-        for time, val in readings:
-            roundedTime = cls._round(time, sampleInterval)
-            if roundedTime in d:
-                d[roundedTime].append(val)
-            else:
-                d[roundedTime] = [val]
-
-        def avg(vals):
-            return sum(vals) / len(vals)
-
-        result = [(rt, avg(vals), len(vals)) for rt, vals in d.items()]
-        result.sort(key=lambda t: t[0])
-        return result
-
     def addReading(self, reading):
-        self.addReadings([reading])
+        t, v = reading
+        self.addReadings([t], [v])
+
+    def addReadings(self, times, values, stopwatch=None):
+        """Add a block of readings, given as a sequence of times and a sequence of values, to our saved list
 
-    def addReadings(self, readings):
-        """Add a list of (time, value) pairs to our saved list"""
-        if len(readings) < 1:
+        stopwatch, a latency.Stopwatch, times each stage if given"""
+        if len(times) < 1:
             return
         # Say our samplerate is 10Hz. We want all our readings to be
         # at the even time interval of .1 seconds
         # Therefore we need to interpolate and downsample our data to mesh with this
         sampleInterval = 1.0 / self.sampleRate
-        downsampled = self._downSampleReadings(readings, sampleInterval)
+        newTimes, newVals, counts = downSampleReadings(times, values, sampleInterval)
         # Now we have to merge the list of new samples with the list of old samples
         # look at time, value, and numsamples of first reading
-        t, v, n = downsampled[0]
+        t, v, n = newTimes[0], newVals[0], counts[0]
+        # index of the first new sample that becomes a brand new point
+        start = 0
         if len(self.data) > 0:
-            lastTime, lastVal = self.data[-1]
+            lastTime, lastVal = self.data.last()
             # The first sample within our new list might overlap
             # with the last sample within the old data
             if fabs(t - lastTime) < sampleInterval:
@@ -135,97 +186,106 @@ class LoadCellControl(QtCore.QObject):
                 avgVal = (lastVal * nslr + v * n) / (nslr + n)
                 newestTime = max(t, lastTime)
                 # Modify the last entry from old data and forget the first entry from new readings
-                self.data[-1] = (newestTime, avgVal)
-                newPoints = downsampled[1:]
-                self.numSamplesLastReading = nslr + n
-            else:
-                # we dont need to merge
-                newPoints = downsampled
-                t, v, self.numSamplesLastReading = downsampled[-1]
-        else:
-            # we dont need to merge
-            newPoints = downsampled
-            t, v, self.numSamplesLastReading = downsampled[-1]
+                self.data.setLast(newestTime, avgVal)
+                start = 1
+                n = nslr + n
+        # the last point might get merged with the next batch of readings
+        self.numSamplesLastReading = n if len(counts) == 1 else counts[-1]
+
+        if stopwatch:
+            stopwatch.lap("downsample")
 
         # cool, so now lets add these
-        timesAndVals = [(t, v) for t, v, n in newPoints]
-        self.data.extend(timesAndVals)
-        for pt in timesAndVals:
-            self.gui.addReading(pt)
+        self.data.extend(newTimes[start:], newVals[start:])
+        if stopwatch:
+            stopwatch.lap("store")
+        self.gui.addReadings(newTimes[start:], newVals[start:])
+        if stopwatch:
+            stopwatch.lap("plot")
 
     @QtCore.pyqtSlot(str, float, float)
     def saveRecording(self, filename, startTime, stopTime):
+        if len(self.session) > 0:
+            # save all the scales, side by side
+            if len(self.data) < 1:
+                # the plot's range means nothing when no scale is selected, so save everything
+                startTime, stopTime = -float("inf"), float("inf")
+            if filename.endswith(".boa"):
+                kwargs = {"calibration": self.calibration, "units": self.gui.units}
+            else:
+                kwargs = {"precision": self.csvPrecision}
+            self.session.save(filename, startTime, stopTime, **kwargs)
+            return
         if len(self.data) < 1:
             return
         # find all the data points between startTime and stopTime
-        arr = np.array(self.data)
-        times = arr[:, 0]
-        ilo, ihi = np.searchsorted(times, [startTime, stopTime])
-        if ilo == ihi:
+        times, values = self.data.between(startTime, stopTime)
+        if len(times) == 0:
             return
-        inRange = arr[ilo:ihi]
         # write those data points to file
-        with open(filename, "w") as out:
-            csv_out = csv.writer(out)
-            csv_out.writerow(["time", "raw reading"])
-            for row in inRange:
-                csv_out.writerow(row)
+        if filename.endswith(".boa"):
+            recording.saveBoa(
+                filename,
+                times,
+                values,
+                sampleRate=self.sampleRate,
+                calibration=self.calibration,
+                units=self.gui.units,
+            )
+            return
+        recording.saveCsv(
+            filename, ["time", "raw reading"], [times, values], self.csvPrecision
+        )
 
     @QtCore.pyqtSlot(str)
     def openRecording(self, filename):
-        with open(filename, "r") as f:
-            self.clear()
-            r = csv.reader(f)
-            pts = []
-            for row in r:
-                try:
-                    time, value = row
-                    pt = (float(time), float(value))
-                    pts.append(pt)
-                except:
-                    # must not have been able to read that row. oh well!
-                    pass
-            self.addReadings(pts)
+        times, values, header = recording.load(filename)
+        self.clear()
+        if header.get("calibration"):
+            self.calibration = Calibration(pts=header["calibration"])
+            self.gui.setCalibration(self.calibration)
+        if values.ndim == 2:
+            # a recording of several scales, just show the first
+            print("showing", header["columns"][1], "of", header["columns"][1:])
+            values = values[0]
+        self.addReadings(times, values)
+
+    def setCsvPrecision(self, precision):
+        """Set the decimal places to save recordings to as csv, or None for full precision"""
+        self.csvPrecision = precision
 
     @QtCore.pyqtSlot(str)
     def openCalibration(self, filename):
-        with open(filename, "r") as f:
-            r = csv.reader(f)
-            pts = []
-            for row in r:
-                try:
-                    measured, real = row
-                    pt = (float(measured), float(real))
-                    pts.append(pt)
-                except:
-                    # must not have been able to read that row. oh well!
-                    pass
-            self.calibration = Calibration(pts=pts)
-            self.gui.setCalibration(self.calibration)
+        self.calibration = Calibration.load(filename)
+        self.gui.setCalibration(self.calibration)
 
     @QtCore.pyqtSlot(str)
     def saveCalibration(self, filename):
         # is our calibration empty? ignore it.
         if len(self.calibration) == 0:
             return
-        with open(filename, "w") as out:
-            csv_out = csv.writer(out)
-            csv_out.writerow(["measured", "real"])
-            for row in self.calibration.pts:
-                csv_out.writerow(row)
+        recording.saveCsv(
+            filename, ["measured", "real"], list(zip(*self.calibration.pts))
+        )
 
     def addScale(self, s):
         if isinstance(s, scale.SerialScale):
             s.baudrate = self.baudrate
         self.scales.append(s)
+        if self.recordAll:
+            self.session.addScale(s)
         self.gui.setScaleList([str(s) for s in self.scales])
 
     def removeScale(self, s):
         self.scales.remove(s)
+        # keep what we recorded from it, it might only have been unplugged for a moment
+        self.session.stopScale(s)
         self.gui.setScaleList([str(s) for s in self.scales])
 
     @QtCore.pyqtSlot(str)
     def useScale(self, name):
+        self.flushJournal()
+        self.lastStats = None
         if name == "Select...":
             self.scale = None
         elif name == "Random Generator":
@@ -240,7 +300,7 @@ class LoadCellControl(QtCore.QObject):
 
     def updateAvailableScales(self):
         scale.updateAvailableScales()
-        available = scale.availableScales()
+        available = scale.availableScales() + self.extraScales
         # print('available scales are', available)
         # clear dead ones
         for s in self.scales:
@@ -251,9 +311,35 @@ class LoadCellControl(QtCore.QObject):
             if s not in self.scales:
                 self.addScale(s)
 
+    @QtCore.pyqtSlot(bool)
+    def setRecordAll(self, recordAll):
+        """Start or stop recording from all the available scales at once"""
+        self.recordAll = recordAll
+        if not recordAll:
+            self.session.removeAll()
+            return
+        for s in self.scales:
+            self.session.addScale(s)
+
+    def updateLinkStats(self):
+        """Show the drop rate of the current scale since the last time we checked"""
+        if not self.scale:
+            self.lastStats = None
+            self.gui.setLinkStats(0, None)
+            return
+        stats = self.scale.stats()
+        last = self.lastStats or dict.fromkeys(stats, 0)
+        missing = stats["missing"] - last["missing"]
+        sent = stats["received"] - last["received"] + missing
+        self.gui.setLinkStats(missing / sent if sent > 0 else 0.0, stats)
+        self.lastStats = stats
+
     @QtCore.pyqtSlot(float)
     def setSampleRate(self, sr):
+        self.flushJournal()
         self.sampleRate = sr
+        self.session.setSampleRate(sr)
+        self.journalDownsampler = Downsampler(1.0 / sr)
 
     @QtCore.pyqtSlot(int)
     def setBaudrate(self, br):
@@ -274,102 +360,61 @@ class LoadCellControl(QtCore.QObject):
         self.gui.setCalibration(self.calibration)
 
 
-class Calibration(object):
-    """Represents a set of (raw reading, real weight) pairs the linear relationship in between them."""
-
-    # 1N = .1019kg = .2248lbs
-    CONVERSIONS = {"N": 1.0, "kg": 0.101971621298, "lbs": 0.2248089431}
-
-    class Fit(object):
-        def __init__(self, m=1, b=0):
-            self.m = m
-            self.b = b
-            # The conversion funtion with slope m and y-intercept b
-            self._f = np.poly1d((m, b))
-
-        def __str__(self):
-            sign = "+" if self.b >= 0 else "-"
-            return "{:.3} x {} {:.3}".format(self.m, sign, abs(self.b))
-
-        def measured2real(self, inp, toUnits="N"):
-            return Calibration.convertBetween(self._f(inp), "N", toUnits)
-
-        def real2measured(self, inp, fromUnits="N"):
-            newtons = Calibration.convertBetween(inp, fromUnits, "N")
-            m2 = 1.0 / self.m
-            b2 = -self.b / self.m
-            f = np.poly1d((m2, b2))
-            return f(newtons)
-
-        def inUnits(self, units):
-            m2 = Calibration.convertBetween(self.m, "N", units)
-            b2 = Calibration.convertBetween(self.b, "N", units)
-            return Calibration.Fit(m2, b2)
-
-    def __init__(self, pts=None, units="N"):
-        self.pts = []
-        self.fit = None
-        if pts:
-            for p in pts:
-                self.addPoint(p, units=units)
-
-    def __repr__(self):
-        if self.fit is None:
-            return "Unfit Calibration for points " + str(self.pts)
-        else:
-            # print((self.fit, self.pts))
-            return str(self.fit) + " Calibration for points " + str(self.pts)
-
-    def __len__(self):
-        return len(self.pts)
-
-    def removePoint(self, pt):
-        try:
-            self.pts.remove(pt)
-            self.fit = self.fitLine(self.pts)
-        except:
-            # pt wasnt in list. whatever
-            pass
-
-    def addPoint(self, pt, units="N"):
-        measured, real = pt
-        # maybe the point was given in different units. Convert back to Newtons before adding it.
-        newreal = self.convertBetween(real, units, "N")
-        pt = measured, newreal
-        if pt not in self.pts:
-            self.pts.append(pt)
-            self.fit = self.fitLine(self.pts)
-
-    def convertedTo(self, units):
-        return Calibration(pts=self.pts, units=units)
-
-    def hasFit(self):
-        return self.fit is not None
-
-    @classmethod
-    def convertBetween(cls, x, fromUnits, toUnits):
-        a = cls.CONVERSIONS[str(toUnits)]
-        b = cls.CONVERSIONS[str(fromUnits)]
-        c = a / b
-        return x * c
-
-    @staticmethod
-    def fitLine(pts):
-        if len(pts) < 2:
-            return None
-        a = np.array(pts)
-        x = a[:, 0]
-        y = a[:, 1]
-        # catch warnings about a bad fit. We'll just take the bad fit, it's fine
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=Warning)
-            # sometimes if you give it a set of pts with an undefined (infinite slope) it has more serious problems
-            try:
-                m, b = np.polyfit(x, y, 1)
-            except ValueError:
-                return None
-            return Calibration.Fit(m, b)
-
-
 if __name__ == "__main__":
-    lcc = LoadCellControl()
+    parser = argparse.ArgumentParser(description="The GUI for reading from scales.")
+    parser.add_argument(
+        "--engine",
+        choices=scale.ENGINES,
+        default=scale.ENGINE,
+        help="read each scale from its own process, or all of them from one asyncio thread",
+    )
+    parser.add_argument(
+        "--protocol",
+        choices=scale.PROTOCOLS,
+        default=scale.PROTOCOL,
+        help="binary if streamer.ino was built with BINARY_PROTOCOL",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="RECORDING",
+        action="append",
+        default=[],
+        help="offer a recording (.csv or .boa) as a scale that plays it back, on a loop",
+    )
+    parser.add_argument(
+        "--speed",
+        type=scale.positiveFloat,
+        default=1.0,
+        help="how many times faster than real time to play back --replay recordings",
+    )
+    parser.add_argument(
+        "--random-rate",
+        type=float,
+        default=80,
+        help="readings per second from the Random Generator (default 80)",
+    )
+    parser.add_argument(
+        "--random-falls",
+        type=float,
+        metavar="SECONDS",
+        help="make the Random Generator add a synthetic fall every SECONDS",
+    )
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="measure how long readings take to get to the screen from the start (see Debug > Latency)",
+    )
+    parser.add_argument(
+        "--latency-file",
+        metavar="FILE",
+        help="measure latency, and write the histograms to FILE on exit",
+    )
+    args = parser.parse_args()
+    latency.ENABLED = args.latency or args.latency_file is not None
+    scale.ENGINE = args.engine
+    scale.PROTOCOL = args.protocol
+    replays = [scale.ReplayScale(r, args.speed, loop=True) for r in args.replay]
+    randomGenerator = scale.PhonyScale(args.random_rate, fallInterval=args.random_falls)
+    lcc = LoadCellControl(replays, randomGenerator)
+    if args.latency_file:
+        latency.histograms.dump(args.latency_file)
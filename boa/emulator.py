@@ -0,0 +1,303 @@
+"""A pretend Arduino on a pseudo-terminal, for trying out the serial code without one.
+
+ArduinoEmulator makes a pty pair and streams readings into one end the way
+streamer.ino does, in either protocol, so a SerialScale can be pointed at
+the other end (emulator.port) and the real SerialReader code does the rest.
+It can also misbehave on purpose: garbage bytes, truncated lines or frames,
+stalls, and disconnects.
+
+Run this file to benchmark the real reader code end to end:
+
+    python3 boa/emulator.py --rate 2000 --seconds 10 --protocol binary --garbage 0.01
+
+Each reading is the index of the reading (mod 2**23), so the benchmark can
+tell when each one was sent and how long it took to come out of read().
+To check the baudrate change and disconnect paths of the reader too:
+
+    python3 boa/emulator.py --baudrate-at 1 --disconnect-at 3 --check
+
+This needs a POSIX system for the pty.
+"""
+import argparse
+import os
+import sys
+import termios
+import threading
+import time
+
+import numpy as np
+
+import scale
+
+
+# in seconds, how long the reader gets to notice a disconnect, see benchmark()
+CLOSE_TIMEOUT = 5
+
+
+class ArduinoEmulator(object):
+    """Streams readings into a pty at rate readings a second, from a background thread.
+
+    Faults, each a probability per batch of readings written:
+        garbage: some random bytes are written before the batch
+        truncate: the last line or frame of the batch is cut short
+        stall: nothing is written for stallTime seconds
+    disconnect() makes it as if the USB cable was pulled.
+    bootTime is how long it waits before streaming, like the Arduino rebooting when the port opens."""
+
+    # in seconds, how often a batch of readings is written
+    TICK = 0.002
+    MAX_VALUE = 2**23
+
+    def __init__(
+        self,
+        rate=80,
+        protocol="ascii",
+        garbage=0.0,
+        truncate=0.0,
+        stall=0.0,
+        stallTime=0.5,
+        bootTime=0.0,
+        seed=None,
+    ):
+        if protocol not in scale.PROTOCOLS:
+            raise ValueError("protocol must be one of {}".format(scale.PROTOCOLS))
+        self.rate = rate
+        self.protocol = protocol
+        self.garbage = garbage
+        self.truncate = truncate
+        self.stall = stall
+        self.stallTime = stallTime
+        self.bootTime = bootTime
+        self._rng = np.random.default_rng(seed)
+        self._master, self._slave = os.openpty()
+        self.port = os.ttyname(self._slave)
+        # when each reading was written, by index
+        self.sendTimes = np.zeros(1024)
+        self.numSent = 0
+        self._quit = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        self._quit.wait(self.bootTime)
+        start = time.time()
+        while not self._quit.is_set():
+            due = int((time.time() - start) * self.rate)
+            if due > self.numSent:
+                try:
+                    self._writeBatch(self.numSent, due)
+                except OSError:
+                    # disconnected
+                    break
+            if self._rng.random() < self.stall:
+                self._quit.wait(self.stallTime)
+            else:
+                self._quit.wait(self.TICK)
+
+    def _writeBatch(self, first, last):
+        indices = np.arange(first, last)
+        values = indices % self.MAX_VALUE
+        if self.protocol == "binary":
+            data = scale.encodeFrames(values, indices)
+        else:
+            data = "".join("%d\r\n" % v for v in values).encode()
+        if self._rng.random() < self.truncate:
+            data = data[: -self._rng.integers(1, 4)]
+        if self._rng.random() < self.garbage:
+            data = self._rng.bytes(self._rng.integers(1, 16)) + data
+        now = time.time()
+        while len(self.sendTimes) < last:
+            self.sendTimes = np.concatenate(
+                (self.sendTimes, np.zeros_like(self.sendTimes))
+            )
+        self.sendTimes[first:last] = now
+        self.numSent = last
+        os.write(self._master, data)
+
+    @property
+    def baudrate(self):
+        """The baudrate that whoever has the port open set it to"""
+        speed = termios.tcgetattr(self._slave)[5]
+        for name in dir(termios):
+            if (
+                name[0] == "B"
+                and name[1:].isdigit()
+                and getattr(termios, name) == speed
+            ):
+                return int(name[1:])
+        return None
+
+    def disconnect(self):
+        """Stop streaming and close our end of the pty, like pulling out the cable"""
+        self._quit.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._master is not None:
+            os.close(self._master)
+            self._master = None
+
+    def close(self):
+        self.disconnect()
+        if self._slave is not None:
+            os.close(self._slave)
+            self._slave = None
+
+
+def benchmark(
+    rate,
+    seconds,
+    protocol="ascii",
+    engine="process",
+    baudrateAt=None,
+    baudrate=115200,
+    disconnectAt=None,
+    **faults
+):
+    """Stream from an ArduinoEmulator through a real SerialScale and return a dict of results
+
+    baudrateAt and disconnectAt are how many seconds in to change the scale's baudrate
+    (to baudrate) and to pull the emulator's cable. After a disconnect we keep going
+    until the scale closes, or up to CLOSE_TIMEOUT seconds more."""
+    scale.ENGINE = engine
+    latencies = []
+    numRead = 0
+    readAfterBaudrate = 0
+    portBaudrate = None
+    disconnected = closed = None
+    with ArduinoEmulator(rate, protocol, **faults) as emulator:
+        s = scale.makeSerialScale(emulator.port, protocol=protocol)
+        start = time.time()
+        while True:
+            time.sleep(1 / 30.0)
+            times, values = s.read()
+            now = time.time()
+            values = values[np.isfinite(values)].astype(np.int64)
+            numRead += len(values)
+            if baudrateAt is not None and now - start >= baudrateAt:
+                if s.baudrate != baudrate:
+                    s.baudrate = baudrate
+                else:
+                    readAfterBaudrate += len(values)
+                    if disconnected is None:
+                        portBaudrate = emulator.baudrate
+            # which reading was it? The newest one sent with that value
+            sent = emulator.numSent
+            indices = (
+                values + (sent - 1 - values) // emulator.MAX_VALUE * emulator.MAX_VALUE
+            )
+            indices = indices[(indices >= 0) & (indices < sent)]
+            latencies.append(now - emulator.sendTimes[indices])
+
+            if disconnectAt is not None and disconnected is None:
+                if now - start >= disconnectAt:
+                    emulator.disconnect()
+                    disconnected = now
+            if disconnected is not None and not s.isOpen():
+                closed = now
+                break
+            if now - start >= seconds and (
+                disconnected is None or now - disconnected >= CLOSE_TIMEOUT
+            ):
+                break
+        elapsed = (disconnected or time.time()) - start
+        stats = s.stats()
+        s.close()
+    latencies = np.concatenate(latencies) if latencies else np.empty(0)
+    result = {
+        "sent": emulator.numSent,
+        "read": numRead,
+        "readingsPerSecond": numRead / elapsed,
+    }
+    if len(latencies):
+        for p in (50, 95, 99):
+            result["latency p{} (ms)".format(p)] = np.percentile(latencies, p) * 1000
+    if baudrateAt is not None:
+        result["read after baudrate change"] = readAfterBaudrate
+        result["port baudrate"] = portBaudrate or 0
+    if disconnected is not None:
+        result["closed after disconnect (s)"] = (
+            closed - disconnected if closed else np.inf
+        )
+    result.update(stats)
+    return result
+
+
+def check(result, baudrate=None):
+    """Return a list of what's wrong with the results of a benchmark() with that baudrate"""
+    problems = []
+    if result["read"] == 0:
+        problems.append("nothing was read")
+    if "read after baudrate change" in result:
+        if result["port baudrate"] != baudrate:
+            problems.append("the reader didn't set the port's baudrate")
+        if result["read after baudrate change"] == 0:
+            problems.append("nothing was read after the baudrate changed")
+    if result.get("closed after disconnect (s)") == np.inf:
+        problems.append("the scale didn't close after the emulator disconnected")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the serial reader code against an emulated Arduino."
+    )
+    parser.add_argument("--rate", type=float, default=80, help="readings per second")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--protocol", choices=scale.PROTOCOLS, default="ascii")
+    parser.add_argument("--engine", choices=scale.ENGINES, default="process")
+    parser.add_argument("--garbage", type=float, default=0.0)
+    parser.add_argument("--truncate", type=float, default=0.0)
+    parser.add_argument("--stall", type=float, default=0.0)
+    parser.add_argument(
+        "--baudrate-at",
+        type=float,
+        metavar="SECONDS",
+        help="change the scale's baudrate this many seconds in",
+    )
+    parser.add_argument("--baudrate", type=int, default=115200)
+    parser.add_argument(
+        "--disconnect-at",
+        type=float,
+        metavar="SECONDS",
+        help="pull the emulator's cable this many seconds in",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="exit with an error unless readings keep coming after a baudrate change and the scale closes after a disconnect",
+    )
+    args = parser.parse_args()
+    result = benchmark(
+        args.rate,
+        args.seconds,
+        args.protocol,
+        args.engine,
+        args.baudrate_at,
+        args.baudrate,
+        args.disconnect_at,
+        garbage=args.garbage,
+        truncate=args.truncate,
+        stall=args.stall,
+    )
+    for k, v in result.items():
+        print("{:>30}: {:.6g}".format(k, v))
+    if args.check:
+        problems = check(result, args.baudrate)
+        for problem in problems:
+            print("FAILED:", problem)
+        if problems:
+            sys.exit(1)
+        print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,59 @@
 from __future__ import division
+import hashlib
+import importlib.util
+import os
 from pathlib import Path
 import time
+import types
 import warnings
 
 import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui, uic
 
-from boa import Calibration
+import latency
+from calibration import Calibration
+from samples import RollingWindow
 
-# dynamically generate the gui skeleton file from the ui file
 this_directory = Path(__file__).parent
-with open(this_directory / "basicgui.py", "w") as pyfile:
-    uic.compileUi(this_directory / "LoadCellControl.ui", pyfile)
-import basicgui
+
+
+def _loadBasicGui():
+    """Import the gui skeleton that is compiled from LoadCellControl.ui.
+
+    Compiling the .ui file is slow, so we only do it when it has changed.
+    If basicgui.py is at least as new as the .ui file, just import it.
+    Otherwise compile into the user's cache directory, keyed by a hash of the
+    .ui file, so we never write to the package directory at runtime."""
+    uiFile = this_directory / "LoadCellControl.ui"
+    shipped = this_directory / "basicgui.py"
+    if shipped.exists() and shipped.stat().st_mtime >= uiFile.stat().st_mtime:
+        import basicgui
+
+        return basicgui
+
+    digest = hashlib.sha1(uiFile.read_bytes()).hexdigest()[:16]
+    cacheDir = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "boa"
+    cached = cacheDir / "basicgui_{}.py".format(digest)
+    try:
+        if not cached.exists():
+            cacheDir.mkdir(parents=True, exist_ok=True)
+            # write then rename, so a half written file is never picked up
+            tmp = cached.with_suffix(".tmp")
+            with open(tmp, "w") as pyfile:
+                uic.compileUi(str(uiFile), pyfile)
+            os.replace(tmp, cached)
+    except OSError:
+        # can't write to the cache either, so build the classes in memory
+        form, _ = uic.loadUiType(str(uiFile))
+        return types.SimpleNamespace(Ui_GUI=form)
+    spec = importlib.util.spec_from_file_location("basicgui", cached)
+    basicgui = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(basicgui)
+    return basicgui
+
+
+basicgui = _loadBasicGui()
 
 
 class GUI(basicgui.Ui_GUI, QtCore.QObject):
@@ -32,6 +72,9 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
     sigSamplesRemoved = QtCore.pyqtSignal(list)
     sigExportRange = QtCore.pyqtSignal(float, float)
     sigClear = QtCore.pyqtSignal()
+    sigRecordAllChanged = QtCore.pyqtSignal(bool)
+    # decimal places, or None for full precision
+    sigCsvPrecisionChanged = QtCore.pyqtSignal(object)
 
     def __init__(self, app):
         QtCore.QObject.__init__(self)
@@ -43,10 +86,12 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         # instance variables
         self.calibration = None
         self.units = "N"
-        # used for displaying the average readings for the last
+        # used for displaying the smoothed readings for the last
         # historyTime in seconds
         self.historyTime = 1
-        self.lastFewReadings = []
+        self.smoother = RollingWindow(self.historyTime)
+        self._setupSmoothingMenu()
+        self._setupDebugMenu()
 
         # set up parts of display
         # The scrolling plot, the calibrationtab consisting of both the table and graph of
@@ -91,25 +136,43 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         self.mainwindow.show()
 
     def addReading(self, reading):
+        timestamp, val = reading
+        self.addReadings([timestamp], [val])
+
+    def addReadings(self, times, values):
+        """Add a block of readings, given as a sequence of times and a sequence of values"""
+        if len(times) < 1:
+            return
         # The plot itself is where the array of data is stored
-        self.plot.add(*reading)
+        self.plot.addMany(times, values)
 
         # Make the LCD 7-segment display show the current weight (using a running average)
-        # clear out any old readings and add this new one
-        timestamp, val = reading
-        cutoffTime = timestamp - self.historyTime
-        self.lastFewReadings = [
-            (t, v) for t, v in self.lastFewReadings if t > cutoffTime
-        ]
-        self.lastFewReadings.append(reading)
-        # show the average reading
-        vals = [v for t, v in self.lastFewReadings]
-        avgVal = sum(vals) / len(vals)
+        # skipping the nans that mark gaps
+        finite = np.isfinite(values)
+        self.smoother.add(np.asarray(times)[finite], np.asarray(values)[finite])
+        self._updateLCD()
+
+    def _updateLCD(self):
+        """Show the smoothed current reading, converted to real units if we can"""
+        avgVal = self.smoother.value()
+        if avgVal is None:
+            return
         if self.calibration and self.calibration.hasFit():
             inNewtons = self.calibration.fit.measured2real(avgVal)
             avgVal = Calibration.convertBetween(inNewtons, "N", self.units)
         self.currentReadingLCD.display(avgVal)
 
+    def setSmoothing(self, mode=None, length=None):
+        """Change how the current reading is smoothed.
+
+        mode is one of RollingWindow.MODES, length is the window length in seconds"""
+        if mode is not None:
+            self.smoother.mode = mode
+        if length is not None:
+            self.historyTime = length
+            self.smoother.length = length
+        self._updateLCD()
+
     def setScaleList(self, scales):
         """Update the list of available scales
 
@@ -132,6 +195,26 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
             if s not in alreadyThere:
                 scb.addItem(s)
 
+    def setLinkStats(self, recentDropRate, stats):
+        """Show how healthy the link to the scale is in the status bar.
+
+        recentDropRate is the fraction of readings lost lately, stats is from Scale.stats(),
+        or None to clear the status bar"""
+        if stats is None:
+            self.mainwindow.statusBar().clearMessage()
+            return
+        self.mainwindow.statusBar().showMessage(
+            "Dropping {:.1%} of readings. In total: {} received, {} missing, "
+            "{} duplicates, {} parse errors, {} overruns".format(
+                recentDropRate,
+                stats["received"],
+                stats["missing"],
+                stats["duplicates"],
+                stats["parseErrors"],
+                stats["overruns"],
+            )
+        )
+
     def getSampleRate(self):
         return self.srsb.value()
 
@@ -157,6 +240,7 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
     def clear(self):
         """Clear all the recorded data from the plots"""
         self.plot.clear()
+        self.smoother.clear()
         self.sigClear.emit()
 
     def _setupMenubar(self):
@@ -174,6 +258,71 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         self.actionOpenRec.triggered.connect(self._openRecording)
         self.actionSaveRecAs.triggered.connect(self._saveRecording)
 
+        # record every available scale at once, and save them all together
+        self.actionRecordAll = self.menuRecordings.addAction("Record From All Scales")
+        self.actionRecordAll.setCheckable(True)
+        self.actionRecordAll.toggled.connect(self.sigRecordAllChanged.emit)
+
+        # how many decimal places to save recordings to as csv
+        menu = self.menuRecordings.addMenu("CSV Precision")
+        precisions = QtGui.QActionGroup(self.mainwindow)
+        for precision in (None, 0, 1, 2, 3, 4, 6):
+            if precision is None:
+                act = menu.addAction("Full")
+            else:
+                act = menu.addAction("{} Decimal Places".format(precision))
+            act.setData(precision)
+            act.setCheckable(True)
+            act.setChecked(precision is None)
+            precisions.addAction(act)
+        precisions.triggered.connect(
+            lambda act: self.sigCsvPrecisionChanged.emit(act.data())
+        )
+
+    def _setupSmoothingMenu(self):
+        """Add a menu for choosing how the current reading display is smoothed"""
+        menu = self.menuBar.addMenu("Current Reading")
+        modeNames = {"mean": "Mean", "median": "Median", "ema": "Exponential"}
+        modes = QtGui.QActionGroup(self.mainwindow)
+        for mode in RollingWindow.MODES:
+            act = menu.addAction(modeNames[mode])
+            act.setData(mode)
+            act.setCheckable(True)
+            act.setChecked(mode == self.smoother.mode)
+            modes.addAction(act)
+        modes.triggered.connect(lambda act: self.setSmoothing(mode=act.data()))
+
+        menu.addSeparator()
+        lengths = QtGui.QActionGroup(self.mainwindow)
+        for seconds in (0.1, 0.25, 0.5, 1, 2, 5):
+            act = menu.addAction("Over {} s".format(seconds))
+            act.setData(seconds)
+            act.setCheckable(True)
+            act.setChecked(seconds == self.historyTime)
+            lengths.addAction(act)
+        lengths.triggered.connect(lambda act: self.setSmoothing(length=act.data()))
+
+    def _setupDebugMenu(self):
+        """Add a menu for measuring how long readings take to get to the screen, see latency.py"""
+        menu = self.menuBar.addMenu("Debug")
+        self.actionMeasureLatency = menu.addAction("Measure Latency")
+        self.actionMeasureLatency.setCheckable(True)
+        self.actionMeasureLatency.setChecked(latency.ENABLED)
+        self.actionMeasureLatency.toggled.connect(self._setMeasureLatency)
+        self.latencyPanel = LatencyPanel(self.mainwindow)
+        self.latencyPanel.hide()
+        self.mainwindow.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.latencyPanel)
+        menu.addAction(self.latencyPanel.toggleViewAction())
+        menu.addAction("Save Latency As...").triggered.connect(self._saveLatency)
+
+    def _setMeasureLatency(self, on):
+        latency.ENABLED = on
+
+    def _saveLatency(self):
+        filename = self._getSaveFile("Save Latency As...", ".", ["Text files (*.txt)"])
+        if filename:
+            latency.histograms.dump(filename)
+
     @QtCore.pyqtSlot(QtGui.QAction)
     def _unitsChanged(self, act):
         """Called when one of the buttons in the menu (a QAction) is triggered"""
@@ -219,7 +368,9 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
 
     @QtCore.pyqtSlot()
     def _openRecording(self):
-        filename = self._getOpenFile("Open Recording...", "recordings")
+        filename = self._getOpenFile(
+            "Open Recording...", "recordings", ["Recordings (*.csv *.boa)"]
+        )
         if not filename:
             # user cancelled
             return
@@ -228,7 +379,11 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
 
     @QtCore.pyqtSlot()
     def _saveRecording(self):
-        filename = self._getSaveFile("Save Recording As...", "recordings")
+        filename = self._getSaveFile(
+            "Save Recording As...",
+            "recordings",
+            ["CSV files (*.csv)", "Boa recordings (*.boa)"],
+        )
         if not filename:
             # user cancelled
             return
@@ -245,8 +400,10 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         dlg.setModal(False)
         return dlg.exec_() == QtGui.QMessageBox.Yes
 
-    def _getSaveFile(self, title, directory):
-        """Return the filename that the user selects to save to, or '' if cancelled"""
+    def _getSaveFile(self, title, directory, nameFilters=("CSV files (*.csv)",)):
+        """Return the filename that the user selects to save to, or '' if cancelled
+
+        If the filename doesn't have the extension of the chosen filter, it gets added"""
         # we CANT do this nice static method since it's blocking
         # filename = QtGui.QFileDialog.getSaveFileName(
         #            self.mainwindow, 'Save File', '', 'CSV files (*.csv)')
@@ -255,17 +412,19 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         dlg.setDirectory(directory)
         dlg.setAcceptMode(QtGui.QFileDialog.AcceptSave)
         dlg.setFileMode(QtGui.QFileDialog.AnyFile)
-        dlg.setNameFilter("CSV files (*.csv)")
+        dlg.setNameFilters(nameFilters)
         dlg.setModal(True)
         if dlg.exec_():
             filename = dlg.selectedFiles()[0]
-            if filename[-4:] != ".csv":
-                filename += ".csv"
+            # eg "CSV files (*.csv)" -> ".csv"
+            extension = dlg.selectedNameFilter().split("*")[-1].rstrip(")")
+            if not filename.endswith(extension):
+                filename += extension
             return filename
         # user cancelled
         return ""
 
-    def _getOpenFile(self, title, directory):
+    def _getOpenFile(self, title, directory, nameFilters=("CSV Files (*.csv)",)):
         """Open a file dialog for choosing either
         calibration or recording data
         we CANT do this nice static method since it's blocking
@@ -275,7 +434,7 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         dlg.setWindowTitle(title)
         dlg.setDirectory(directory)
         dlg.setFileMode(QtGui.QFileDialog.ExistingFile)
-        dlg.setNameFilter("CSV Files (*.csv)")
+        dlg.setNameFilters(nameFilters)
         dlg.setModal(False)
         if dlg.exec_():
             filename = dlg.selectedFiles()[0]
@@ -284,6 +443,45 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         return ""
 
 
+class LatencyPanel(QtGui.QDockWidget):
+    """Shows the latency percentiles of every stage, updated every second while it's visible"""
+
+    def __init__(self, parent):
+        super().__init__("Latency", parent)
+        self.text = QtGui.QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        clearButton = QtGui.QPushButton("Clear")
+        clearButton.clicked.connect(self._clear)
+        layout = QtGui.QVBoxLayout()
+        layout.addWidget(self.text)
+        layout.addWidget(clearButton)
+        widget = QtGui.QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self._visibilityChanged)
+
+    def _visibilityChanged(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start(1000)
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        text = latency.histograms.summary()
+        if not latency.ENABLED:
+            text = "Turn on Debug > Measure Latency to measure\n\n" + text
+        self.text.setPlainText(text)
+
+    def _clear(self):
+        latency.histograms.clear()
+        self.refresh()
+
+
 class Wrapper(object):
     """A class for objects that will wrap around already
     instantiated objects of another class. We are wrapping
@@ -438,29 +636,31 @@ class Plot(Wrapper, QtCore.QObject):
         axis.setFlag(axis.ItemNegativeZStacksBehindParent)
 
     def add(self, timestamp, val):
-        """Add one data point to the plot.
+        """Add one data point to the plot."""
+        self.addMany([timestamp], [val])
 
+    def addMany(self, times, values):
+        """Add a block of data points to the plot.
 
-        The Plot object stores data in a list of plot items
+        The Plot object stores data in a list of plot items, each holding chunkSize points.
+        Each chunk that gets new points is redrawn only once, no matter how many points it got.
         """
-        i = self._ptr % self.chunkSize
-        if i == 0:
-            curve = self.plot()
-            self._curves.append(curve)
-            last = self._current[-1]
-            self._current = np.empty((self.chunkSize + 1, 2))
-            if len(self._curves) > 1:
-                self._current[0] = last
-            else:
-                self._current[0] = [timestamp, val]
-            while len(self._curves) > self.maxChunks:
-                c = self._curves.pop(0)
-                self.removeItem(c)
-        else:
-            curve = self._curves[-1]
-        self._current[i + 1] = [timestamp, val]
-        curve.setData(x=self._current[: i + 2, 0], y=self._current[: i + 2, 1])
-        self._ptr += 1
+        n = len(times)
+        if n == 0:
+            return
+        done = 0
+        while done < n:
+            i = self._ptr % self.chunkSize
+            if i == 0:
+                self._startChunk(times[done], values[done])
+            take = min(self.chunkSize - i, n - done)
+            self._current[i + 1 : i + 1 + take, 0] = times[done : done + take]
+            self._current[i + 1 : i + 1 + take, 1] = values[done : done + take]
+            self._curves[-1].setData(
+                x=self._current[: i + 1 + take, 0], y=self._current[: i + 1 + take, 1]
+            )
+            self._ptr += take
+            done += take
 
         if self.doAutoscroll:
             oldViewRange = self.getViewBox().viewRange()[0]
@@ -468,6 +668,21 @@ class Plot(Wrapper, QtCore.QObject):
             mostRecentTime = self._curves[-1].xData[-1]
             self.setXRange(mostRecentTime - span, mostRecentTime, padding=0)
 
+    def _startChunk(self, timestamp, val):
+        """Start a new curve, which begins where the last one left off"""
+        # a nan (a gap in the readings, see scale.GAP) breaks the line instead of hiding it
+        curve = self.plot(connect="finite")
+        self._curves.append(curve)
+        last = self._current[-1]
+        self._current = np.empty((self.chunkSize + 1, 2))
+        if len(self._curves) > 1:
+            self._current[0] = last
+        else:
+            self._current[0] = [timestamp, val]
+        while len(self._curves) > self.maxChunks:
+            c = self._curves.pop(0)
+            self.removeItem(c)
+
     def clear(self):
         for c in self._curves:
             self.removeItem(c)
@@ -0,0 +1,76 @@
+"""Noticing when devices are plugged in or unplugged.
+
+On Linux this uses inotify on /dev (through ctypes, so there's nothing to
+install), so we hear about a new serial port as soon as udev makes it.
+Anywhere else DevWatcher.wait() just sleeps, and the caller polls."""
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x004
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class DevWatcher(object):
+    """Waits for files in a directory (by default /dev) to come, go, or change permissions"""
+
+    # udev creates the device file and then fixes its permissions, so give it a moment
+    SETTLE_TIME = 0.2
+
+    def __init__(self, directory="/dev"):
+        self.directory = directory
+        self._fd = None
+        if sys.platform.startswith("linux"):
+            try:
+                self._fd = self._inotify(directory)
+            except (OSError, AttributeError) as e:
+                print("can't watch", directory, "for new devices, polling instead:", e)
+
+    @property
+    def canWatch(self):
+        """Whether wait() really waits for changes, instead of just sleeping"""
+        return self._fd is not None
+
+    @staticmethod
+    def _inotify(directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CREATE | IN_DELETE | IN_ATTRIB
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, "inotify_add_watch failed")
+        return fd
+
+    def wait(self, timeout):
+        """Wait until something in the directory changes, or timeout seconds.
+
+        Returns True if something changed, False if we timed out (or can't tell)."""
+        if self._fd is None:
+            time.sleep(timeout)
+            return False
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        time.sleep(self.SETTLE_TIME)
+        # we don't care what the events were, just that there were some
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
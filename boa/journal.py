@@ -0,0 +1,195 @@
+"""A crash-safe, append-only log of everything read from a scale.
+
+While acquiring, every downsampled sample is appended to segment files in a
+directory, so even if the app crashes (or nobody clicks Save Recording) the
+data is on disk. Each segment is:
+
+    8 bytes    MAGIC
+    rows of (time, value), each a little endian float64
+
+so a segment is complete up to its last whole row, no matter where a crash
+cut it off. To turn (part of) a journal into a normal recording:
+
+    python3 boa/journal.py recordings/journal out.boa --start 1494283837 --stop 1494283900
+"""
+import argparse
+import os
+from pathlib import Path
+import threading
+import time
+
+import numpy as np
+
+import recording
+
+MAGIC = b"BOALOG\x00\x01"
+ROW = np.dtype([("time", "<f8"), ("value", "<f8")])
+SUFFIX = ".boalog"
+
+
+class Journal(object):
+    """Appends samples to segment files in directory.
+
+    The file is fsynced every fsyncInterval seconds from a background thread,
+    since fsync can take tens of milliseconds and append() is called from the GUI's repaint timer.
+    A new segment is started once the current one is maxSegmentSize bytes or maxSegmentDuration seconds long.
+    When opened, any partial row left at the end of a segment by a crash is trimmed off."""
+
+    def __init__(
+        self,
+        directory,
+        fsyncInterval=1.0,
+        maxSegmentSize=32 * 2**20,
+        maxSegmentDuration=60 * 60,
+    ):
+        self.directory = Path(directory)
+        self.fsyncInterval = fsyncInterval
+        self.maxSegmentSize = maxSegmentSize
+        self.maxSegmentDuration = maxSegmentDuration
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.recover()
+        self._file = None
+        self._segmentSize = 0
+        self._segmentStart = 0
+        # held while using self._file, which the sync thread shares with us
+        self._lock = threading.Lock()
+        self._syncThread = threading.Thread(
+            target=self._syncPeriodically, name="journal sync", daemon=True
+        )
+        self._syncThread.start()
+
+    def segments(self):
+        """The paths of all the segments, oldest first"""
+        return sorted(self.directory.glob("*" + SUFFIX))
+
+    def recover(self):
+        """Trim any partial rows off the ends of the segments, and remove segments with no header"""
+        for path in self.segments():
+            size = path.stat().st_size
+            if size < len(MAGIC):
+                path.unlink()
+                continue
+            whole = len(MAGIC) + (size - len(MAGIC)) // ROW.itemsize * ROW.itemsize
+            if whole != size:
+                print("recovering", path, "trimming", size - whole, "bytes")
+                os.truncate(path, whole)
+
+    def append(self, times, values):
+        """Append a batch of samples"""
+        if len(times) == 0:
+            return
+        now = time.time()
+        if (
+            self._file is None
+            or self._segmentSize >= self.maxSegmentSize
+            or now - self._segmentStart >= self.maxSegmentDuration
+        ):
+            self._startSegment(now)
+        rows = np.empty(len(times), ROW)
+        rows["time"] = times
+        rows["value"] = values
+        with self._lock:
+            self._file.write(rows.tobytes())
+        self._segmentSize += rows.nbytes
+
+    def _startSegment(self, now):
+        self.close()
+        segments = self.segments()
+        index = int(segments[-1].name.split("_")[0]) + 1 if segments else 0
+        name = "{:06d}_{}{}".format(
+            index, time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(now)), SUFFIX
+        )
+        f = open(self.directory / name, "wb")
+        f.write(MAGIC)
+        with self._lock:
+            self._file = f
+        self._segmentSize = len(MAGIC)
+        self._segmentStart = now
+        self.sync()
+
+    def _syncPeriodically(self):
+        while True:
+            time.sleep(self.fsyncInterval)
+            try:
+                self.sync()
+            except OSError as e:
+                print("couldn't sync the journal:", e)
+
+    def sync(self):
+        """Make sure everything appended so far is on disk"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            # fsync a duplicate so we don't hold the lock (and block append()) while it runs,
+            # and so it's still valid if the segment gets closed meanwhile
+            fd = os.dup(self._file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        with self._lock:
+            self._file.close()
+            self._file = None
+
+    def read(self, startTime=-np.inf, stopTime=np.inf):
+        """Return (times, values) of all the samples in the journal with startTime <= time < stopTime"""
+        self.sync()
+        times = []
+        values = []
+        for path in self.segments():
+            t, v = readSegment(path)
+            keep = (t >= startTime) & (t < stopTime)
+            times.append(t[keep])
+            values.append(v[keep])
+        if not times:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(times), np.concatenate(values)
+
+
+def readSegment(path):
+    """Return (times, values) of the whole rows in a segment file, memory mapped"""
+    size = os.path.getsize(path)
+    n = max(0, size - len(MAGIC)) // ROW.itemsize
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a journal segment".format(path))
+    if n == 0:
+        return np.empty(0), np.empty(0)
+    rows = np.memmap(path, dtype=ROW, mode="r", offset=len(MAGIC), shape=(n,))
+    return rows["time"], rows["value"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Save (part of) a journal as a .csv or .boa recording."
+    )
+    parser.add_argument("directory")
+    parser.add_argument("output", help="a .csv or .boa file")
+    parser.add_argument("--start", type=float, default=-np.inf, help="unix time")
+    parser.add_argument("--stop", type=float, default=np.inf, help="unix time")
+    args = parser.parse_args()
+
+    # don't use Journal(), which would trim segments that might still be being written to
+    times, values = [], []
+    for path in sorted(Path(args.directory).glob("*" + SUFFIX)):
+        t, v = readSegment(path)
+        keep = (t >= args.start) & (t < args.stop)
+        times.append(t[keep])
+        values.append(v[keep])
+    times = np.concatenate(times) if times else np.empty(0)
+    values = np.concatenate(values) if values else np.empty(0)
+    if args.output.endswith(".boa"):
+        recording.saveBoa(args.output, times, values)
+    else:
+        recording.saveCsv(args.output, ["time", "raw reading"], [times, values])
+    print("saved", len(times), "samples to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Measuring how long readings take to get from the scale to the screen.
+
+When ENABLED, each stage a reading goes through records how long it took
+in a histogram, and summary() gives the 50th, 95th and 99th percentiles of
+each. The stages, in order:
+
+    batching:     from the reader getting the bytes to writing them to the ring buffer
+    handoff:      from the ring buffer to read() in the main process (mostly waiting for the repaint timer)
+    read:         reading the scale (or session) and writing to the journal
+    downsample:   downsampling and merging into the recorded samples
+    store:        adding them to the SampleStore
+    plot:         adding them to the plot and the current reading display
+    repaint:      from there until the event loop has had a chance to repaint
+    end to end:   from the reader getting the bytes to the repaint
+
+batching and handoff are measured for the newest block of readings in each read(),
+so they (and end to end) are only measured for scales with a RingBuffer, not PhonyScale or ReplayScale.
+When disabled, the only cost is checking ENABLED once per stage.
+"""
+import time
+import weakref
+
+import numpy as np
+
+ENABLED = False
+
+STAGES = (
+    "batching",
+    "handoff",
+    "read",
+    "downsample",
+    "store",
+    "plot",
+    "repaint",
+    "end to end",
+)
+
+
+class LatencyHistograms(object):
+    """A histogram of latencies for each stage, with log spaced bins from 10 us to 100 s"""
+
+    # edges of the bins, in seconds. 40 bins per factor of 10, so percentiles are within 6%
+    EDGES = np.logspace(-5, 2, 7 * 40 + 1)
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # one extra bin on each end for anything outside the edges
+        self.counts = {
+            stage: np.zeros(len(self.EDGES) + 1, np.int64) for stage in STAGES
+        }
+
+    def record(self, stage, seconds):
+        """Add one latency, or an array of them"""
+        bins = np.searchsorted(self.EDGES, seconds)
+        if np.ndim(bins) == 0:
+            self.counts[stage][bins] += 1
+        else:
+            self.counts[stage] += np.bincount(bins, minlength=len(self.EDGES) + 1)
+
+    def percentiles(self, stage, ps=(50, 95, 99)):
+        """Return the latencies at the percentiles ps, in seconds, or None if nothing was recorded"""
+        counts = self.counts[stage]
+        total = counts.sum()
+        if total == 0:
+            return None
+        cumulative = np.cumsum(counts)
+        result = []
+        for p in ps:
+            i = int(np.searchsorted(cumulative, total * p / 100.0))
+            # the middle of the bin, geometrically
+            lo = self.EDGES[max(i - 1, 0)]
+            hi = self.EDGES[min(i, len(self.EDGES) - 1)]
+            result.append(np.sqrt(lo * hi))
+        return result
+
+    def summary(self):
+        """A table of the count and p50/p95/p99 in milliseconds of every stage, as text"""
+        lines = [
+            "{:<12} {:>8} {:>10} {:>10} {:>10}".format(
+                "stage", "count", "p50 ms", "p95 ms", "p99 ms"
+            )
+        ]
+        for stage in STAGES:
+            ps = self.percentiles(stage)
+            count = self.counts[stage].sum()
+            if ps is None:
+                lines.append("{:<12} {:>8}".format(stage, count))
+            else:
+                lines.append(
+                    "{:<12} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                        stage, count, *[1000 * p for p in ps]
+                    )
+                )
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        """Write the summary, and then the raw histograms as csv, to filename"""
+        with open(filename, "w") as f:
+            f.write(self.summary())
+            f.write("\n\nbin upper edge (s)," + ",".join(STAGES) + "\n")
+            edges = list(self.EDGES) + [np.inf]
+            for i, edge in enumerate(edges):
+                f.write(
+                    "{!r},".format(float(edge))
+                    + ",".join(str(self.counts[s][i]) for s in STAGES)
+                    + "\n"
+                )
+
+
+histograms = LatencyHistograms()
+
+
+def record(stage, seconds):
+    if ENABLED:
+        histograms.record(stage, seconds)
+
+
+# RingBuffer -> its numWritten when recordRing() last recorded it
+_lastRecorded = weakref.WeakKeyDictionary()
+
+
+def recordRing(ring, readTime):
+    """Record batching and handoff for the newest block written to a RingBuffer, read at readTime.
+
+    Each block is only recorded once, so nothing is recorded if nothing was
+    written since the last call. Returns when the block arrived, or None if it wasn't recorded"""
+    if not ENABLED or ring is None:
+        return None
+    numWritten = ring.numWritten
+    if numWritten == _lastRecorded.get(ring, 0):
+        return None
+    _lastRecorded[ring] = numWritten
+    arrival, written = ring.lastWriteTimes()
+    histograms.record("batching", written - arrival)
+    histograms.record("handoff", readTime - written)
+    return arrival
+
+
+class Stopwatch(object):
+    """Times the stages that run one after another in the main process.
+
+    Does nothing if not ENABLED when it was made"""
+
+    def __init__(self):
+        self.enabled = ENABLED
+        if self.enabled:
+            self._last = time.perf_counter()
+
+    def lap(self, stage):
+        """Record the time since the last lap (or since we were made) as stage"""
+        if self.enabled:
+            now = time.perf_counter()
+            histograms.record(stage, now - self._last)
+            self._last = now
@@ -0,0 +1,156 @@
+"""boa-record: record from a scale without the GUI.
+
+Useful for an unattended rig where nobody is watching the plot. Nothing in
+here imports Qt or pyqtgraph, so it starts fast and stays small.
+
+    python3 boa/record.py --port /dev/ttyUSB0 --sample-rate 80
+    python3 boa/record.py --bluetooth 98:D3:31:FB:2C:4E
+"""
+import argparse
+import signal
+import sys
+import time
+
+import recording
+import scale
+from calibration import Calibration
+from samples import Downsampler
+
+
+class Recorder(object):
+    """Reads from a scale and continuously appends the downsampled readings to a csv file"""
+
+    # in seconds
+    POLL_INTERVAL = 0.1
+    STATUS_INTERVAL = 1.0
+
+    def __init__(
+        self, scale, filename, sampleRate, calibration=None, units="N", precision=None
+    ):
+        self.scale = scale
+        self.filename = filename
+        self.precision = precision
+        self.downsampler = Downsampler(1.0 / sampleRate)
+        self.calibration = calibration
+        self.units = units
+        self.numSamples = 0
+        self._stop = False
+
+    def stop(self, *args):
+        self._stop = True
+
+    def run(self):
+        """Record until stop() is called or the scale goes away"""
+        with open(self.filename, "wb") as out:
+            out.write(recording.csvHeader(["time", "raw reading"]))
+            lastStatus = time.time()
+            while not self._stop and self.scale.isOpen():
+                time.sleep(self.POLL_INTERVAL)
+                times, values = self.downsampler.add(*self.scale.read())
+                self._write(out, times, values)
+                # make sure it's on disk in case we crash
+                out.flush()
+                now = time.time()
+                if len(values) and now - lastStatus > self.STATUS_INTERVAL:
+                    self._printStatus(values[-1])
+                    lastStatus = now
+            self._write(out, *self.downsampler.flush())
+        print("\nrecorded", self.numSamples, "samples to", self.filename)
+
+    def _write(self, out, times, values):
+        out.write(recording.formatCsv([times, values], self.precision))
+        self.numSamples += len(times)
+
+    def _printStatus(self, lastValue):
+        if self.calibration is not None and self.calibration.hasFit():
+            reading = "{:.1f} {}".format(
+                self.calibration.fit.measured2real(lastValue, self.units), self.units
+            )
+        else:
+            reading = "{:.0f} raw".format(lastValue)
+        sys.stdout.write(
+            "\r{} samples, current reading {}    ".format(self.numSamples, reading)
+        )
+        sys.stdout.flush()
+
+
+def parseArgs(args=None):
+    parser = argparse.ArgumentParser(
+        prog="boa-record", description="Record from a scale without the GUI."
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--port", help="serial port of a USB scale, eg /dev/ttyUSB0")
+    source.add_argument(
+        "--bluetooth", metavar="ADDRESS", help="address of a bluetooth scale"
+    )
+    source.add_argument(
+        "--replay",
+        metavar="RECORDING",
+        help="play back a recording (.csv or .boa) instead, eg for benchmarking",
+    )
+    parser.add_argument(
+        "--speed",
+        type=scale.positiveFloat,
+        help="how many times faster than real time to --replay (default as fast as possible)",
+    )
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument(
+        "--protocol",
+        choices=scale.PROTOCOLS,
+        default="ascii",
+        help="binary if streamer.ino was built with BINARY_PROTOCOL (default ascii)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=scale.ENGINES,
+        default="process",
+        help="read the scale from a separate process or from an asyncio thread (default process)",
+    )
+    parser.add_argument(
+        "--sample-rate",
+        type=float,
+        default=80,
+        help="samples per second to record (default 80)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="csv file to write to (default recordings/<date and time>.csv)",
+    )
+    parser.add_argument(
+        "--calibration",
+        help="calibration csv, only used for showing the current reading",
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        help="decimal places to write (default is full precision)",
+    )
+    parser.add_argument("--units", choices=sorted(Calibration.CONVERSIONS), default="N")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parseArgs(args)
+    output = args.output or time.strftime("recordings/%Y-%m-%d_%H-%M-%S.csv")
+    calibration = Calibration.load(args.calibration) if args.calibration else None
+    scale.ENGINE = args.engine
+    if args.replay:
+        s = scale.ReplayScale(args.replay, args.speed)
+    elif args.port:
+        s = scale.makeSerialScale(args.port, args.baudrate, args.protocol)
+    else:
+        s = scale.makeBluetoothScale(args.bluetooth, args.bluetooth, args.protocol)
+
+    recorder = Recorder(
+        s, output, args.sample_rate, calibration, args.units, args.precision
+    )
+    signal.signal(signal.SIGINT, recorder.stop)
+    signal.signal(signal.SIGTERM, recorder.stop)
+    print("recording from", s, "to", output, "(ctrl-C to stop)")
+    recorder.run()
+    s.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""Reading and writing recordings.
+
+Recordings are either .csv files of (time, raw reading) rows, or .boa files.
+A recording of several scales has a column per scale after the time, in either.
+
+A .boa file is:
+    8 bytes    MAGIC
+    4 bytes    little endian uint32, the length of the json header
+    the json header, padded with spaces so the data starts on a multiple of 64 bytes
+    the data, little endian float64, one contiguous column after another
+
+The header holds "columns" (the name of each column, the first is always "time"),
+"length" (the number of rows), and optionally "sampleRate", "units", and
+"calibration" (a list of (measured, real weight in newtons) points).
+Since the columns are contiguous, loading is just a np.memmap.
+
+To convert the old .csv recordings:
+
+    python3 boa/recording.py recordings/*.csv
+"""
+import csv
+import itertools
+import json
+import struct
+import sys
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"BOAREC\x00\x01"
+ALIGNMENT = 64
+DTYPE = np.dtype("<f8")
+# in bytes
+CSV_CHUNK_SIZE = 1 << 20
+
+
+class MalformedRowsWarning(UserWarning):
+    """Some rows of a .csv recording couldn't be read and were skipped"""
+
+
+def saveBoa(
+    filename,
+    times,
+    values,
+    names=("raw reading",),
+    sampleRate=None,
+    calibration=None,
+    units=None,
+):
+    """Write a .boa file.
+
+    values is either one sequence of values, or a 2D array with one row per channel,
+    in which case names should have one name per channel."""
+    values = np.atleast_2d(np.asarray(values, dtype=DTYPE))
+    times = np.asarray(times, dtype=DTYPE)
+    if values.shape[1] != len(times):
+        raise ValueError("need the same number of times and values")
+    if len(names) != len(values):
+        raise ValueError("need one name for each channel")
+    header = {
+        "version": 1,
+        "columns": ["time"] + list(names),
+        "length": len(times),
+    }
+    if sampleRate is not None:
+        header["sampleRate"] = sampleRate
+    if units is not None:
+        header["units"] = units
+    if calibration:
+        header["calibration"] = [list(pt) for pt in calibration.pts]
+    headerBytes = json.dumps(header).encode()
+    unpadded = len(MAGIC) + 4 + len(headerBytes)
+    headerBytes += b" " * (-unpadded % ALIGNMENT)
+    with open(filename, "wb") as out:
+        out.write(MAGIC)
+        out.write(struct.pack("<I", len(headerBytes)))
+        out.write(headerBytes)
+        out.write(times.tobytes())
+        out.write(values.tobytes())
+
+
+def readBoaHeader(filename):
+    """Return (header dict, offset in bytes of the start of the data)"""
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("{} is not a .boa recording".format(filename))
+        (headerLength,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(headerLength).decode())
+    return header, len(MAGIC) + 4 + headerLength
+
+
+def loadBoa(filename):
+    """Return (times, values, header) from a .boa file.
+
+    times and values are read-only memory mapped arrays, so this is quick no matter how big the file is.
+    values is 1D if there is one channel, otherwise it has one row per channel."""
+    header, offset = readBoaHeader(filename)
+    shape = (len(header["columns"]), header["length"])
+    if shape[1] == 0:
+        data = np.empty(shape)
+    else:
+        data = np.memmap(filename, dtype=DTYPE, mode="r", offset=offset, shape=shape)
+    times = data[0]
+    values = data[1] if shape[0] == 2 else data[1:]
+    return times, values, header
+
+
+def iterCsv(filename, chunkSize=CSV_CHUNK_SIZE):
+    """Yield (times, values) arrays from a .csv recording, chunkSize bytes of the file at a time.
+
+    values is 1D if there is one value column, otherwise it has one row per column,
+    like loadBoa(). The number of columns is taken from the first row.
+    Each chunk is parsed in one go by numpy. Only if that fails is the chunk parsed
+    row by row, to find the rows that are malformed. Those are skipped, and reported
+    with a MalformedRowsWarning once the whole file has been read.
+    A first row that isn't numbers is taken to be the header."""
+    bad = []
+    lineNumber = 1
+    with open(filename, "r") as f:
+        first = f.readline()
+        numColumns = first.count(",") + 1 if first else 2
+        if first and _parseRow(first, numColumns) is not None:
+            # no header, put it back
+            f.seek(0)
+            lineNumber = 0
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            # finish off the last line of the chunk
+            chunk += f.readline()
+            if not chunk.endswith("\n"):
+                chunk += "\n"
+            nLines = chunk.count("\n")
+            rows = _parseChunk(chunk, nLines, numColumns)
+            if rows is None:
+                rows = []
+                for i, line in enumerate(chunk.splitlines(), lineNumber + 1):
+                    row = _parseRow(line, numColumns)
+                    if row is None:
+                        bad.append((i, line))
+                    else:
+                        rows.append(row)
+                rows = np.array(rows, dtype=float).reshape(-1, numColumns)
+            lineNumber += nLines
+            yield rows[:, 0], _valueColumns(rows)
+    if bad:
+        warnings.warn(
+            "skipped {} malformed rows in {}, starting with line {}: {!r}".format(
+                len(bad), filename, *bad[0]
+            ),
+            MalformedRowsWarning,
+        )
+
+
+def _valueColumns(rows):
+    """The values of an array of rows, 1D if there's one value column, otherwise one row per column"""
+    return rows[:, 1] if rows.shape[1] == 2 else rows[:, 1:].T
+
+
+def _parseChunk(chunk, nLines, numColumns=2):
+    """Parse a chunk of nLines complete rows of numColumns numbers, or return None if any of them are malformed"""
+    if chunk.count(",") != nLines * (numColumns - 1):
+        return None
+    try:
+        with warnings.catch_warnings():
+            # older versions of numpy just warn and stop early when they hit something that isn't a number
+            warnings.simplefilter("error", DeprecationWarning)
+            flat = np.fromstring(chunk.replace(",", " "), sep=" ")
+    except (ValueError, DeprecationWarning):
+        return None
+    if len(flat) != numColumns * nLines:
+        # probably a blank line
+        return None
+    return flat.reshape(nLines, numColumns)
+
+
+def _parseRow(line, numColumns=2):
+    """Return a tuple of the numColumns numbers in one csv line, or None if it's malformed"""
+    try:
+        (row,) = csv.reader([line])
+        if len(row) != numColumns:
+            return None
+        return tuple(float(x) for x in row)
+    except ValueError:
+        return None
+
+
+def loadCsv(filename):
+    """Return (times, values) from a .csv recording, see iterCsv()"""
+    chunks = list(iterCsv(filename))
+    if not chunks:
+        numColumns = len(readCsvHeader(filename))
+        return np.empty(0), _valueColumns(np.empty((0, numColumns)))
+    times, values = zip(*chunks)
+    return np.concatenate(times), np.concatenate(values, axis=-1)
+
+
+def readCsvHeader(filename):
+    """Return the names of the columns of a .csv recording.
+
+    If it has no header row they are made up, eg ["time", "raw reading 1", "raw reading 2"]"""
+    with open(filename, "r") as f:
+        first = f.readline()
+    numColumns = first.count(",") + 1 if first else 2
+    if first and _parseRow(first, numColumns) is None:
+        (names,) = csv.reader([first])
+        return names
+    if numColumns == 2:
+        return ["time", "raw reading"]
+    return ["time"] + ["raw reading {}".format(i) for i in range(1, numColumns)]
+
+
+def csvHeader(names):
+    """The header row of a .csv file, as bytes"""
+    return (",".join(names) + "\r\n").encode()
+
+
+def formatCsv(columns, precision=None):
+    """Format columns of numbers as .csv rows, all at once, and return the bytes.
+
+    The output is exactly what csv.writer would write (CRLF line endings).
+    If precision is None, every number is written in full, the same as repr().
+    Otherwise every number is rounded to that many decimal places, which is done
+    with numpy all at once and so is much faster. Since it's rounded from the float
+    x * 10**precision, the last digit can be one off from what "%f" would give."""
+    if len(columns) == 0 or len(columns[0]) == 0:
+        return b""
+    if precision is not None:
+        result = _formatFixed(columns, precision)
+        if result is not None:
+            return result
+    field = "%r" if precision is None else "%.{}f".format(precision)
+    row = ",".join([field] * len(columns)) + "\r\n"
+    columns = [c.tolist() if isinstance(c, np.ndarray) else c for c in columns]
+    flat = tuple(itertools.chain.from_iterable(zip(*columns)))
+    return ((row * len(columns[0])) % flat).encode()
+
+
+# the characters of every number from 0000 to 9999
+_DIGITS = np.array([list(b"%04d" % i) for i in range(10000)], np.uint8)
+
+
+def _digitChars(x, numDigits):
+    """A (len(x), numDigits) array of the characters of the nonnegative integers x, zero padded on the left"""
+    numGroups = -(-numDigits // 4)
+    chars = np.empty((len(x), numGroups * 4), np.uint8)
+    # four digits at a time, from the right
+    for g in range(numGroups - 1, -1, -1):
+        x, r = np.divmod(x, 10000)
+        chars[:, g * 4 : g * 4 + 4] = _DIGITS[r]
+    return chars[:, numGroups * 4 - numDigits :]
+
+
+def _formatFixed(columns, precision):
+    """Format the columns with numpy, building the characters of every row at once.
+
+    Returns None if some of the numbers can't be done this way (nan, inf, or too big)"""
+    columns = [np.asarray(c, dtype=float) for c in columns]
+    n = len(columns[0])
+    scale = 10**precision
+    # Pieces of each row, each a (n, width) array of characters.
+    # 0 means no character there (eg a leading zero), and those get stripped at the end
+    pieces = []
+    for i, column in enumerate(columns):
+        if not np.all(np.isfinite(column)):
+            return None
+        scaled = np.rint(np.abs(column) * scale)
+        # beyond this, floats can't hold every integer exactly
+        if scaled.max() >= 2**53:
+            return None
+        whole, fraction = np.divmod(scaled.astype(np.int64), scale)
+
+        pieces.append(np.where(np.signbit(column), ord("-"), 0)[:, None])
+        numDigits = len(str(whole.max()))
+        powers = 10 ** np.arange(numDigits - 1, 0, -1, dtype=np.int64)
+        chars = _digitChars(whole, numDigits)
+        # leave off leading zeros, but always keep the ones digit
+        chars[:, :-1] *= whole[:, None] >= powers
+        pieces.append(chars)
+        if precision > 0:
+            pieces.append(np.full((n, 1), ord("."), np.uint8))
+            pieces.append(_digitChars(fraction, precision))
+        end = b"," if i < len(columns) - 1 else b"\r\n"
+        pieces.append(np.tile(np.frombuffer(end, np.uint8), (n, 1)))
+
+    chars = np.hstack([p.astype(np.uint8, copy=False) for p in pieces])
+    return chars.tobytes().replace(b"\0", b"")
+
+
+def saveCsv(filename, names, columns, precision=None):
+    """Write a .csv file with a header row of names and then the columns. See formatCsv()"""
+    with open(filename, "wb") as out:
+        out.write(csvHeader(names))
+        out.write(formatCsv(columns, precision))
+
+
+def load(filename):
+    """Return (times, values, header) from either a .boa or .csv recording.
+
+    The header of a .csv recording only has "columns", and only if it has several value columns."""
+    if str(filename).endswith(".boa"):
+        return loadBoa(filename)
+    times, values = loadCsv(filename)
+    header = {}
+    if values.ndim == 2:
+        header["columns"] = readCsvHeader(filename)
+    return times, values, header
+
+
+def convert(csvFilename, boaFilename=None):
+    """Convert a .csv recording to a .boa recording next to it. Returns the new filename"""
+    if boaFilename is None:
+        boaFilename = Path(csvFilename).with_suffix(".boa")
+    times, values = loadCsv(csvFilename)
+    if values.ndim == 2:
+        saveBoa(boaFilename, times, values, names=readCsvHeader(csvFilename)[1:])
+    else:
+        saveBoa(boaFilename, times, values)
+    return boaFilename
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 recording.py RECORDING.csv [RECORDING.csv ...]")
+        sys.exit(1)
+    for csvFilename in sys.argv[1:]:
+        print(csvFilename, "->", convert(csvFilename))
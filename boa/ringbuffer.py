@@ -0,0 +1,147 @@
+"""A ring buffer of readings living in shared memory.
+
+Used to hand readings from a reader process to the main process without
+pickling anything or taking any locks."""
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """A single-producer/single-consumer ring buffer of (timestamp, raw reading) pairs.
+
+    The writer never waits for the reader. If the reader falls more than
+    `capacity` readings behind, the oldest readings are overwritten and
+    counted in `overruns`, so we always know exactly how many were lost.
+
+    Both cursors only ever increase; the slot for cursor c is c % capacity.
+    The write cursor is only bumped after the data is in place, so the reader
+    never sees half-written readings."""
+
+    # indices into the header
+    WRITE = 0
+    READ = 1
+    OVERRUNS = 2
+    # for measuring latency, in nanoseconds: when the newest block's first bytes arrived, and when it was written
+    ARRIVED = 3
+    WRITTEN = 4
+    HEADER_SIZE = 5
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._owner = True
+        self._shm = shared_memory.SharedMemory(create=True, size=self._nbytes(capacity))
+        self._setupArrays()
+        self._header[:] = 0
+
+    @classmethod
+    def _nbytes(cls, capacity):
+        return cls.HEADER_SIZE * 8 + capacity * (8 + 4)
+
+    def _setupArrays(self):
+        buf = self._shm.buf
+        offset = 0
+        self._header = np.ndarray((self.HEADER_SIZE,), np.int64, buf, offset)
+        offset += self._header.nbytes
+        self._times = np.ndarray((self.capacity,), np.float64, buf, offset)
+        offset += self._times.nbytes
+        self._values = np.ndarray((self.capacity,), np.int32, buf, offset)
+
+    def __getstate__(self):
+        # When a reader process gets started with "spawn" it gets a copy of us,
+        # so just pass along what we need to attach to the same memory
+        return {"name": self._shm.name, "capacity": self.capacity}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self._owner = False
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._setupArrays()
+
+    def __len__(self):
+        """How many readings are waiting to be read (including ones that will be lost to overruns)"""
+        return int(self._header[self.WRITE] - self._header[self.READ])
+
+    @property
+    def overruns(self):
+        """The total number of readings that were overwritten before they were read"""
+        return int(self._header[self.OVERRUNS])
+
+    @property
+    def numWritten(self):
+        """The total number of readings ever written"""
+        return int(self._header[self.WRITE])
+
+    def write(self, times, values, arrived=None):
+        """Append the readings. Only ever call this from the one producer.
+
+        arrived is when the first of them arrived (by time.time()), if known, see lastWriteTimes()"""
+        n = len(times)
+        if n == 0:
+            return
+        w = int(self._header[self.WRITE])
+        # if we are given more than fits, only the newest ones can survive anyway
+        times = times[-self.capacity :]
+        values = values[-self.capacity :]
+        start = (w + n - len(times)) % self.capacity
+        self._copyIn(start, times, values)
+        self._header[self.WRITE] = w + n
+        written = time.time_ns()
+        self._header[self.ARRIVED] = written if arrived is None else int(arrived * 1e9)
+        self._header[self.WRITTEN] = written
+
+    def _copyIn(self, start, times, values):
+        first = min(len(times), self.capacity - start)
+        self._times[start : start + first] = times[:first]
+        self._values[start : start + first] = values[:first]
+        rest = len(times) - first
+        self._times[:rest] = times[first:]
+        self._values[:rest] = values[first:]
+
+    def _copyOut(self, r, n):
+        start = r % self.capacity
+        first = min(n, self.capacity - start)
+        rest = n - first
+        if rest:
+            times = np.concatenate((self._times[start:], self._times[:rest]))
+            values = np.concatenate((self._values[start:], self._values[:rest]))
+        else:
+            times = self._times[start : start + n].copy()
+            values = self._values[start : start + n].copy()
+        return times, values
+
+    def read(self):
+        """Return (times, values) of all the readings since the last read(). Only ever call this from the one consumer.
+
+        The results are copies, since the writer is free to reuse the slots as soon as we return."""
+        r = int(self._header[self.READ])
+        w = int(self._header[self.WRITE])
+        lost = max(0, w - r - self.capacity)
+        r += lost
+        times, values = self._copyOut(r, w - r)
+        # The writer might have lapped us while we were copying, in which case
+        # the oldest few we copied could be garbage.
+        clobbered = max(0, int(self._header[self.WRITE]) - self.capacity - r)
+        if clobbered:
+            times = times[clobbered:]
+            values = values[clobbered:]
+            lost += clobbered
+        self._header[self.OVERRUNS] += lost
+        self._header[self.READ] = w
+        return times, values.astype(np.float64)
+
+    def lastWriteTimes(self):
+        """Return (arrived, written) of the newest block, in seconds by time.time(), or (0, 0) if nothing was written yet"""
+        return self._header[self.ARRIVED] / 1e9, self._header[self.WRITTEN] / 1e9
+
+    def close(self):
+        """Detach from the shared memory. The owner also frees it."""
+        # numpy views into the buffer must be gone before it can be closed
+        self._header = self._times = self._values = None
+        self._shm.close()
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,241 @@
+"""Storage for the (time, value) readings that make up a recording."""
+from collections import deque
+from math import exp
+
+import numpy as np
+
+
+def downSampleReadings(times, values, sampleInterval):
+    """Round all times to multiples of sampleInterval, averaging all readings from the same rounded time.
+
+    Takes a sequence of times and a sequence of values.
+    Returns three arrays (roundedTimes, averagedValues, numSamplesPerRoundedTime), sorted by time.
+
+    ex: [1, 3, 4], [4, 6, 8] -> [0, 5], [4, 7], [1, 2] for sampleInterval = 5"""
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    # which multiple of sampleInterval is each time closest to? (ties go to even, same as round())
+    multiples = np.rint(times / sampleInterval)
+    if np.all(multiples[1:] >= multiples[:-1]):
+        # Readings almost always come in order, so we can skip sorting
+        startsBin = np.empty(len(multiples), dtype=bool)
+        startsBin[:1] = True
+        startsBin[1:] = multiples[1:] != multiples[:-1]
+        uniqueMultiples = multiples[startsBin]
+        whichBin = np.cumsum(startsBin) - 1
+    else:
+        uniqueMultiples, whichBin = np.unique(multiples, return_inverse=True)
+    counts = np.bincount(whichBin)
+    sums = np.bincount(whichBin, weights=values)
+    return uniqueMultiples * sampleInterval, sums / counts, counts
+
+
+class Downsampler(object):
+    """Downsamples a stream of batches of readings, for writing straight to disk.
+
+    The newest rounded time in a batch might get more readings in the next
+    batch, so it is held back until a reading for a later time shows up.
+    Every sample that comes out of add() is final."""
+
+    def __init__(self, sampleInterval):
+        self.sampleInterval = sampleInterval
+        # (time, value, numSamples) of the held back sample
+        self._pending = None
+
+    def add(self, times, values):
+        """Add a batch of readings and return (times, values) arrays of all the samples that are now complete"""
+        if len(times) < 1:
+            return np.empty(0), np.empty(0)
+        newTimes, newVals, counts = downSampleReadings(
+            times, values, self.sampleInterval
+        )
+        if self._pending is not None:
+            t, v, n = self._pending
+            if newTimes[0] == t:
+                # merge the held back sample with the first new one
+                newVals[0] = (v * n + newVals[0] * counts[0]) / (n + counts[0])
+                counts[0] += n
+            else:
+                newTimes = np.concatenate(([t], newTimes))
+                newVals = np.concatenate(([v], newVals))
+                counts = np.concatenate(([n], counts))
+        self._pending = newTimes[-1], newVals[-1], counts[-1]
+        return newTimes[:-1], newVals[:-1]
+
+    def flush(self):
+        """Return (times, values) of the held back sample, if there is one"""
+        if self._pending is None:
+            return np.empty(0), np.empty(0)
+        t, v, n = self._pending
+        self._pending = None
+        return np.array([t]), np.array([v])
+
+
+class RollingWindow(object):
+    """Smooths the most recent readings, for showing the current reading.
+
+    mode is one of MODES:
+        "mean": the average of the readings from the last `length` seconds
+        "median": the median of the readings from the last `length` seconds
+        "ema": an exponential moving average with a time constant of `length` seconds
+
+    Adding a reading is O(1): the window is a deque with a running sum,
+    and old readings are evicted from the front as time moves on."""
+
+    MODES = ("mean", "median", "ema")
+
+    def __init__(self, length=1.0, mode="mean"):
+        if mode not in self.MODES:
+            raise ValueError("mode must be one of {}".format(self.MODES))
+        self.length = length
+        self.mode = mode
+        self._window = deque()
+        self._sum = 0.0
+        self._ema = None
+        self._lastTime = None
+
+    def __len__(self):
+        return len(self._window)
+
+    def add(self, times, values):
+        """Add a sequence of times and a sequence of values"""
+        window = self._window
+        for t, v in zip(times, values):
+            window.append((t, v))
+            self._sum += v
+            if self._ema is None:
+                self._ema = v
+            else:
+                alpha = 1 - exp(-max(t - self._lastTime, 0) / self.length)
+                self._ema += alpha * (v - self._ema)
+            self._lastTime = t
+        if not window:
+            return
+        cutoffTime = window[-1][0] - self.length
+        while window[0][0] <= cutoffTime:
+            t, v = window.popleft()
+            self._sum -= v
+        # all the old ones were evicted, so the sum is just the one left
+        if len(window) == 1:
+            self._sum = window[0][1]
+
+    def value(self):
+        """The current smoothed value, or None if we haven't seen any readings"""
+        if not self._window:
+            return None
+        if self.mode == "mean":
+            return self._sum / len(self._window)
+        elif self.mode == "median":
+            return float(np.median([v for t, v in self._window]))
+        else:
+            return self._ema
+
+    def clear(self):
+        self._window.clear()
+        self._sum = 0.0
+        self._ema = None
+        self._lastTime = None
+
+
+class SampleStore(object):
+    """Holds up to maxlen (time, value) samples in preallocated numpy columns.
+
+    Like a deque with a maxlen, once it's full the oldest samples are dropped
+    to make room for new ones. Times are assumed to be increasing.
+
+    The columns are circular, but every sample is written twice, at i and at
+    i + capacity, so the most recent `capacity` samples are always one
+    contiguous slice and we can hand out views instead of copies.
+    The columns start small and double in size as needed, up to maxlen."""
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._capacity = min(self.INITIAL_CAPACITY, maxlen)
+        self._times = np.empty(2 * self._capacity)
+        self._values = np.empty(2 * self._capacity)
+        # index of the oldest sample within the first half of the columns
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def times(self):
+        """A read-only view of all the times, oldest first"""
+        return self._view(self._times)
+
+    @property
+    def values(self):
+        """A read-only view of all the values, oldest first"""
+        return self._view(self._values)
+
+    def _view(self, column):
+        v = column[self._start : self._start + self._len]
+        v.flags.writeable = False
+        return v
+
+    def last(self):
+        """The (time, value) of the most recent sample"""
+        if not self._len:
+            raise IndexError("last() of an empty SampleStore")
+        i = self._start + self._len - 1
+        return self._times[i], self._values[i]
+
+    def setLast(self, t, v):
+        """Overwrite the most recent sample"""
+        if not self._len:
+            raise IndexError("setLast() of an empty SampleStore")
+        i = (self._start + self._len - 1) % self._capacity
+        self._times[i] = self._times[i + self._capacity] = t
+        self._values[i] = self._values[i + self._capacity] = v
+
+    def extend(self, times, values):
+        """Append a batch of samples, dropping the oldest if we would go over maxlen"""
+        times = np.asarray(times, dtype=float)[-self.maxlen :]
+        values = np.asarray(values, dtype=float)[-self.maxlen :]
+        n = len(times)
+        if n == 0:
+            return
+        if self._len + n > self._capacity and self._capacity < self.maxlen:
+            self._grow(self._len + n)
+        cap = self._capacity
+        # first slot after the newest sample
+        end = (self._start + self._len) % cap
+        first = min(n, cap - end)
+        for column, new in ((self._times, times), (self._values, values)):
+            column[end : end + first] = new[:first]
+            column[end + cap : end + cap + first] = new[:first]
+            rest = n - first
+            column[:rest] = new[first:]
+            column[cap : cap + rest] = new[first:]
+        overflow = max(0, self._len + n - cap)
+        self._start = (self._start + overflow) % cap
+        self._len = min(cap, self._len + n)
+
+    def _grow(self, needed):
+        cap = self._capacity
+        while cap < needed:
+            cap *= 2
+        cap = min(cap, self.maxlen)
+        times = np.empty(2 * cap)
+        values = np.empty(2 * cap)
+        for new, old in ((times, self.times), (values, self.values)):
+            new[: self._len] = old
+            new[cap : cap + self._len] = old
+        self._times = times
+        self._values = values
+        self._capacity = cap
+        self._start = 0
+
+    def between(self, startTime, stopTime):
+        """Return (times, values) views of all the samples with startTime <= time < stopTime"""
+        times = self.times
+        lo, hi = np.searchsorted(times, [startTime, stopTime])
+        return times[lo:hi], self.values[lo:hi]
+
+    def clear(self):
+        self._start = 0
+        self._len = 0
@@ -1,20 +1,88 @@
+import argparse
 import atexit
-import glob
+import json
 import multiprocessing
-import sys
+import os
+from pathlib import Path
+import queue
+import threading
 import time
+import weakref
 
 import bluetooth as bt
-import numpy.random as rand
+import numpy as np
 import serial
+from serial.tools import list_ports
+
+import hotplug
+import recording
+from ringbuffer import RingBuffer
+
+# What the scales found by the searchers speak, see PROTOCOLS.
+# Set this to "binary" if streamer.ino was built with BINARY_PROTOCOL
+PROTOCOL = "ascii"
+# A reading that marks a gap in the readings, eg while a bluetooth scale reconnects.
+# It never comes from the HX711, which is only 24 bits. read() turns it into nan
+GAP = np.iinfo(np.int32).min
+
+# How scales are read. "process" starts a reader process for each scale,
+# "asyncio" reads them all from one event loop, see acquisition.py. Set this before making any scales.
+ENGINES = ("process", "asyncio")
+ENGINE = "process"
+
+
+def makeSerialScale(port, baudrate=9600, protocol="ascii"):
+    """Return a SerialScale that is read the way ENGINE says"""
+    if ENGINE == "asyncio":
+        # acquisition imports us, so import it only when needed
+        import acquisition
+
+        return acquisition.AsyncSerialScale(port, baudrate, protocol)
+    return SerialScale(port, baudrate, protocol)
+
+
+def makeBluetoothScale(address, name, protocol="ascii"):
+    """Return a BluetoothScale that is read the way ENGINE says"""
+    if ENGINE == "asyncio":
+        import acquisition
+
+        return acquisition.AsyncBluetoothScale(address, name, protocol)
+    return BluetoothScale(address, name, protocol)
 
 
 class SerialScaleSearcher(object):
     """Abstract class used to searching for scales connected via USB serial cable.
 
-    This search is pretty fast so we don't have to do it in a different process"""
+    The searching happens in a background thread, so the GUI never waits on it.
+    Only USB serial ports whose vendor and product IDs are in USB_IDS are tried,
+    and ports that can't be opened, or that opened but never sent a reading,
+    aren't tried again for RETRY_INTERVAL seconds.
+    The thread rescans as soon as something changes in /dev (see hotplug.py),
+    or every RESCAN_INTERVAL seconds if it can't watch /dev."""
 
     availableScales = []
+    # (vendor id, product id) of the USB serial chips our arduinos use
+    USB_IDS = {
+        (0x2341, 0x0043),  # Arduino Uno
+        (0x2341, 0x0001),  # older Arduino Uno
+        (0x2A03, 0x0043),  # Arduino Uno from arduino.org
+        (0x1A86, 0x7523),  # CH340, on most clones
+        (0x0403, 0x6001),  # FTDI FT232
+        (0x10C4, 0xEA60),  # Silicon Labs CP210x
+    }
+    # in seconds
+    RETRY_INTERVAL = 30
+    RESCAN_INTERVAL = 1
+    # rescan even when watching /dev, in case we missed something
+    WATCHED_RESCAN_INTERVAL = 30
+
+    Q = queue.Queue()
+    # ports that we have a scale for, or have found and are about to
+    _claimed = set()
+    # port -> time when we can try opening it again, for ports that couldn't be
+    # opened or whose scale died without a reading
+    _rejected = {}
+    _thread = None
 
     def __init__(self):
         raise NotImplementedError(
@@ -23,47 +91,98 @@ class SerialScaleSearcher(object):
 
     @classmethod
     def update(cls):
-        # remove dead scales
+        # remove dead scales, and let their ports be found again
+        for s in cls.availableScales:
+            if not s.isOpen():
+                if s.stats()["received"] == 0:
+                    # it opened, but never sent a reading, so it's probably not one of our scales
+                    cls._rejected[s.port] = time.time() + cls.RETRY_INTERVAL
+                cls._claimed.discard(s.port)
+                s.release()
         cls.availableScales = [s for s in cls.availableScales if s.isOpen()]
 
-        # get all possible ports
-        if sys.platform.startswith("win"):
-            ports = ["COM%s" % (i + 1) for i in range(256)]
-        elif sys.platform.startswith("linux") or sys.platform.startswith("cygwin"):
-            # this excludes your current terminal "/dev/tty"
-            ports = glob.glob("/dev/tty[A-Za-z]*")
-        elif sys.platform.startswith("darwin"):
-            ports = glob.glob("/dev/tty.*")
+        # add the new ones the thread found
+        while not cls.Q.empty():
+            port = cls.Q.get()
+            cls.availableScales.append(makeSerialScale(port, protocol=PROTOCOL))
+
+        if cls._thread is None:
+            cls._thread = threading.Thread(target=cls._search, daemon=True)
+            cls._thread.start()
+
+    @classmethod
+    def _search(cls):
+        watcher = hotplug.DevWatcher()
+        if watcher.canWatch:
+            interval = cls.WATCHED_RESCAN_INTERVAL
         else:
-            raise EnvironmentError("Unsupported platform")
-
-        # filter out the bad ones, ignoring ones we already have added and add them
-        alreadyOpenPorts = [
-            s.port for s in cls.availableScales if isinstance(s, SerialScale)
-        ]
-        for port in ports:
-            if port in alreadyOpenPorts:
+            interval = cls.RESCAN_INTERVAL
+        while True:
+            cls._scan()
+            watcher.wait(interval)
+
+    @classmethod
+    def _scan(cls):
+        now = time.time()
+        ports = [p for p in list_ports.comports() if cls.isCandidate(p)]
+        # forget about ports that went away, so they get tried as soon as they come back
+        present = {p.device for p in ports}
+        for port in list(cls._rejected):
+            if port not in present:
+                del cls._rejected[port]
+
+        for port in present:
+            if port in cls._claimed or cls._rejected.get(port, 0) > now:
                 continue
             try:
                 # try to open it
                 s = serial.Serial(port)
                 s.close()
-                # hurray, we got here, so this is a good port. Add it.
-                cls.availableScales.append(SerialScale(port))
             except (OSError, serial.SerialException):
-                pass
+                cls._rejected[port] = now + cls.RETRY_INTERVAL
+                continue
+            # hurray, we got here, so this is a good port
+            cls._claimed.add(port)
+            cls.Q.put(port)
+
+    @classmethod
+    def isCandidate(cls, portInfo):
+        """Could the port (from serial.tools.list_ports) be one of our scales?"""
+        return (portInfo.vid, portInfo.pid) in cls.USB_IDS
 
 
 class BluetoothScaleSearcher(object):
     """Abstract class used to search for available bluetooth scales.
 
-    The actual search is blocking, and takes a few seconds, so that is done in a different process"""
+    The searching is blocking and slow, so it's done by one long lived thread.
+    Every HC-05 it ever finds is remembered in CACHE_FILE, and those addresses
+    are checked directly with a quick name lookup every KNOWN_INTERVAL seconds,
+    which is much cheaper than a full inquiry. Full inquiries happen every
+    SCAN_INTERVAL seconds, backing off up to MAX_SCAN_INTERVAL while they
+    keep finding nothing new.
+    Inquiries slow down RFCOMM links, so while any bluetooth scale is connected
+    no searching happens at all."""
 
     availableScales = []
-    _amSearchingFlag = multiprocessing.Event()
-    Q = multiprocessing.Queue()
+    Q = queue.Queue()
 
     SCALE_NAME = "HC-05"
+    CACHE_FILE = (
+        Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+        / "boa"
+        / "bluetooth.json"
+    )
+    # in seconds
+    SCAN_INTERVAL = 10
+    MAX_SCAN_INTERVAL = 5 * 60
+    KNOWN_INTERVAL = 5
+    LOOKUP_TIMEOUT = 5
+    # how often to check if we can start searching again
+    PAUSED_INTERVAL = 1
+
+    # addresses that we have a scale for, or have found and are about to
+    _claimed = set()
+    _thread = None
 
     def __init__(self):
         raise NotImplementedError(
@@ -73,52 +192,255 @@ class BluetoothScaleSearcher(object):
     @classmethod
     def update(cls):
         # prune dead scales
+        for s in cls.availableScales:
+            if not s.isOpen():
+                cls._claimed.discard(s.address)
+                s.release()
         cls.availableScales = [s for s in cls.availableScales if s.isOpen()]
         # add create new Scales
         while not cls.Q.empty():
             addr, name = cls.Q.get()
-            scale = BluetoothScale(addr, name)
+            scale = makeBluetoothScale(addr, name, PROTOCOL)
             cls.availableScales.append(scale)
 
-        # maybe skip the rest
-        if cls._amSearchingFlag.is_set():
-            return
+        if cls._thread is None:
+            cls._thread = threading.Thread(target=cls._search, daemon=True)
+            cls._thread.start()
+
+    @classmethod
+    def isStreaming(cls):
+        """Is a bluetooth scale connected? If so we don't search, so we don't slow it down"""
+        return any(s.isConnected() for s in cls.availableScales)
 
-        def search():
+    @classmethod
+    def _search(cls):
+        known = cls._loadKnown()
+        scanInterval = cls.SCAN_INTERVAL
+        nextScan = nextKnownCheck = 0
+        while True:
+            time.sleep(cls.PAUSED_INTERVAL)
+            now = time.time()
+            if cls.isStreaming():
+                continue
+            if now >= nextKnownCheck:
+                nextKnownCheck = now + cls.KNOWN_INTERVAL
+                cls._checkKnown(known)
+            if now >= nextScan and not cls.isStreaming():
+                if cls._inquire(known):
+                    scanInterval = cls.SCAN_INTERVAL
+                else:
+                    scanInterval = min(2 * scanInterval, cls.MAX_SCAN_INTERVAL)
+                nextScan = time.time() + scanInterval
+
+    @classmethod
+    def _checkKnown(cls, known):
+        """Look for the scales we've seen before"""
+        for addr in known:
+            if addr in cls._claimed or cls.isStreaming():
+                continue
             try:
-                print("starting scan for bluetooth scales")
-                nearby_devices = bt.discover_devices(
-                    lookup_names=True, flush_cache=True
-                )
-                for addr, name in nearby_devices:
-                    print("found a device", addr, name)
-                    if name == cls.SCALE_NAME and addr not in openAddresses:
-                        cls.Q.put((addr, name))
+                name = bt.lookup_name(addr, timeout=cls.LOOKUP_TIMEOUT)
             except bt.BluetoothError as e:
                 print(e)
-                pass
-            finally:
-                cls._amSearchingFlag.clear()
+                continue
+            if name == cls.SCALE_NAME:
+                print("found a known scale", addr)
+                cls._found(addr, name)
+
+    @classmethod
+    def _inquire(cls, known):
+        """Do a full inquiry scan. Returns whether we found any new scales"""
+        foundNew = False
+        try:
+            print("starting scan for bluetooth scales")
+            nearby_devices = bt.discover_devices(lookup_names=True, flush_cache=True)
+        except bt.BluetoothError as e:
+            print(e)
+            return False
+        for addr, name in nearby_devices:
+            print("found a device", addr, name)
+            if name != cls.SCALE_NAME:
+                continue
+            if addr not in known:
+                known.append(addr)
+                cls._saveKnown(known)
+                foundNew = True
+            if addr not in cls._claimed:
+                cls._found(addr, name)
+                foundNew = True
+        return foundNew
+
+    @classmethod
+    def _found(cls, addr, name):
+        cls._claimed.add(addr)
+        cls.Q.put((addr, name))
 
-        openAddresses = [s.address for s in cls.availableScales]
-        p = multiprocessing.Process(target=search)
-        p.daemon = True
-        cls._amSearchingFlag.set()
-        p.start()
+    @classmethod
+    def _loadKnown(cls):
+        try:
+            with open(cls.CACHE_FILE) as f:
+                return list(json.load(f))
+        except (OSError, ValueError):
+            return []
+
+    @classmethod
+    def _saveKnown(cls, known):
+        try:
+            cls.CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with open(cls.CACHE_FILE, "w") as f:
+                json.dump(known, f)
+        except OSError as e:
+            print("couldn't save the known bluetooth scales:", e)
 
 
 def updateAvailableScales():
-    # SerialScaleSearcher.update()
+    SerialScaleSearcher.update()
     BluetoothScaleSearcher.update()
-    pass
 
 
 def availableScales():
-    result = SerialScaleSearcher.availableScales
+    result = list(SerialScaleSearcher.availableScales)
     result.extend(BluetoothScaleSearcher.availableScales)
     return result
 
 
+class ClockFit(object):
+    """Works out when each reading was taken, from its index in everything the device has sent.
+
+    Readings get to us in bursts, whenever the USB or bluetooth stack hands
+    over a buffer, so their arrival times jitter by tens of milliseconds.
+    The device takes them at a steady rate though, so we fit a line of arrival
+    time against index and read the timestamps off the line. It's a running
+    least squares fit that forgets old arrivals over TIME_CONSTANT seconds,
+    so it follows the device's clock as it drifts against ours."""
+
+    # in seconds
+    TIME_CONSTANT = 30.0
+    # if an arrival is this far off the line, the device must have restarted or
+    # we lost track of its index, so start a new fit
+    MAX_ERROR = 1.0
+    # how many readings we need to have seen before we trust the fit
+    MIN_SPAN = 40
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # everything is relative to the first arrival, to keep the sums small
+        self._origin = None
+        # weighted sums of 1, index, time, index**2, index*time
+        self._sums = np.zeros(5)
+        self._lastArrival = None
+        self._span = 0
+
+    def add(self, index, arrival):
+        """Add the arrival time of the reading with this index"""
+        if self._origin is not None:
+            predicted = self.times([index])
+            if predicted is not None and abs(predicted[0] - arrival) > self.MAX_ERROR:
+                self.reset()
+        if self._origin is None:
+            self._origin = (index, arrival)
+        else:
+            self._sums *= np.exp(-(arrival - self._lastArrival) / self.TIME_CONSTANT)
+        self._lastArrival = arrival
+        x = index - self._origin[0]
+        y = arrival - self._origin[1]
+        self._sums += (1, x, y, x * x, x * y)
+        self._span = max(self._span, x)
+
+    def times(self, indices):
+        """Return an array of the times the readings with these indices were taken, or None if we can't tell yet"""
+        if self._origin is None or self._span < self.MIN_SPAN:
+            return None
+        w, sx, sy, sxx, sxy = self._sums
+        det = w * sxx - sx * sx
+        if det <= 0:
+            return None
+        slope = (w * sxy - sx * sy) / det
+        intercept = (sy - slope * sx) / w
+        x = np.asarray(indices, dtype=float) - self._origin[0]
+        return self._origin[1] + intercept + slope * x
+
+
+class BlockSender(object):
+    """Used by the reader processes to send readings to the main process in blocks.
+
+    Readings are collected here and written to the RingBuffer as one block
+    every FLUSH_INTERVAL seconds or every MAX_BLOCK_SIZE readings, whichever comes first."""
+
+    FLUSH_INTERVAL = 0.03
+    MAX_BLOCK_SIZE = 1000
+    # after a long silence don't smear the next readings back over the whole silence
+    MAX_SPREAD = 0.25
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.clock = ClockFit()
+        # timestamps never go backwards, even when the fit moves
+        self._lastTime = -np.inf
+        # chunks of readings waiting to be written
+        self._times = []
+        self._values = []
+        self._count = 0
+        self._lastArrival = time.time()
+        self._lastFlush = self._lastArrival
+        # when the first readings waiting to be written arrived
+        self._firstArrival = None
+
+    def add(self, readings, indices=None):
+        """Add a sequence of readings that all just arrived at the same time.
+
+        If we have their indices (see LinkStats.count()) they are timestamped with a ClockFit"""
+        now = time.time()
+        n = len(readings)
+        if n:
+            times = None
+            if indices is not None:
+                self.clock.add(indices[-1], now)
+                times = self.clock.times(indices)
+            if times is None:
+                # They all arrived at once, so spread their timestamps evenly
+                # over the time since the last arrival instead of stamping them all with now
+                span = min(now - self._lastArrival, self.MAX_SPREAD)
+                times = now + np.arange(1 - n, 1) * (span / n)
+            times = np.maximum.accumulate(np.maximum(times, self._lastTime))
+            self._lastTime = times[-1]
+            self._lastArrival = now
+            if self._firstArrival is None:
+                self._firstArrival = now
+            self._times.append(times)
+            self._values.append(np.asarray(readings, dtype=np.int32))
+            self._count += n
+        if (
+            self._count >= self.MAX_BLOCK_SIZE
+            or now - self._lastFlush >= self.FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def markGap(self, t):
+        """Add a GAP reading at time t (to be sent with the next flush)"""
+        t = max(t, self._lastTime)
+        self._lastTime = t
+        self._times.append(np.array([t]))
+        self._values.append(np.array([GAP], dtype=np.int32))
+        self._count += 1
+
+    def flush(self):
+        self._lastFlush = time.time()
+        if not self._count:
+            return
+        self.ring.write(
+            np.concatenate(self._times),
+            np.concatenate(self._values),
+            self._firstArrival,
+        )
+        self._times = []
+        self._values = []
+        self._count = 0
+        self._firstArrival = None
+
+
 class Scale(object):
     """Abstract class which is inherited by SerialScale and BluetoothScale"""
 
@@ -132,23 +454,69 @@ class Scale(object):
         raise NotImplementedError("close() must be overriden in subclasses")
 
     def read(self):
+        """Return (times, values), two numpy arrays of all the readings since the last read()"""
         raise NotImplementedError("read() must be overriden in subclasses")
 
+    def stats(self):
+        """Return a dict of the counts in LinkStats.FIELDS, "dropRate",
+        and "overruns" (readings lost because we didn't read() fast enough)"""
+        raise NotImplementedError("stats() must be overriden in subclasses")
+
+    def _openRing(self, capacity):
+        """Make self.ring, for a reader to write to"""
+        self.ring = RingBuffer(capacity)
+        self._overruns = 0
+        # freed by release(), or when we're garbage collected, or at exit
+        self._freeRing = weakref.finalize(self, self.ring.close)
+
+    def release(self):
+        """Free our ring buffer, if we have one, once we're closed and won't be read again.
+
+        Does nothing while we're still open. read() returns nothing afterwards"""
+        if getattr(self, "ring", None) is None or self.isOpen():
+            return
+        self._overruns = self.ring.overruns
+        self.ring = None
+        self._freeRing()
+
+    @property
+    def overruns(self):
+        """How many readings were lost because we didn't read() fast enough"""
+        if self.ring is None:
+            return self._overruns
+        return self.ring.overruns
+
+
+def readRing(ring):
+    """Read a RingBuffer that readers write to, with any GAP readings turned into nan.
+
+    A ring that was released (None) has nothing to read"""
+    if ring is None:
+        return np.empty(0), np.empty(0)
+    times, values = ring.read()
+    values[values == GAP] = np.nan
+    return times, values
+
 
 class SerialScale(Scale):
     """A scale which is connected via USB serial cable"""
 
-    MAX_BUFFERED_READINGS = 10000
+    # about 13 minutes at 80Hz
+    MAX_BUFFERED_READINGS = 2**16
 
-    def __init__(self, port, baudrate=9600):
+    def __init__(self, port, baudrate=9600, protocol="ascii"):
 
         self.port = port
         self._baudrate = baudrate
+        self.protocol = protocol
 
         # ok, the serial is open, now create the process to constantly read from the port
-        self.readingsQ = multiprocessing.Queue(self.MAX_BUFFERED_READINGS)
+        self._openRing(self.MAX_BUFFERED_READINGS)
         self.commandQ = multiprocessing.Queue()
-        self.reader = SerialReader(port, baudrate, self.readingsQ, self.commandQ)
+        self.linkStats = LinkStats()
+        self.reader = SerialReader(
+            port, baudrate, self.ring, self.commandQ, self.linkStats, protocol
+        )
         self.reader.start()
 
     def __repr__(self):
@@ -181,10 +549,249 @@ class SerialScale(Scale):
         self.commandQ.put({"attr": "baudrate", "val": newval})
 
     def read(self):
+        return readRing(self.ring)
+
+    def stats(self):
+        result = self.linkStats.asDict()
+        result["overruns"] = self.overruns
+        return result
+
+
+class LineFramer(object):
+    """Splits a stream of bytes into CRLF terminated lines.
+
+    Whatever comes after the last terminator is kept and glued onto the
+    front of the next chunk, so a line split across two reads isn't lost."""
+
+    TERMINATOR = b"\r\n"
+
+    def __init__(self, maxLineLength):
+        self.maxLineLength = maxLineLength
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add some bytes and return a list of all the lines that are now complete (without the terminators)"""
+        self._buffer += data
+        end = self._buffer.rfind(self.TERMINATOR)
+        if end < 0:
+            # If we never see a terminator (probably a wrong baudrate) don't grow forever.
+            # Keep the last byte in case it's the first half of a terminator.
+            if len(self._buffer) > self.maxLineLength:
+                del self._buffer[:-1]
+            return []
+        lines = bytes(self._buffer[:end]).split(self.TERMINATOR)
+        del self._buffer[: end + len(self.TERMINATOR)]
+        return lines
+
+    def decode(self, data):
+        """Add some bytes and return (readings, None, parseErrors) for all the lines that are now complete.
+
+        readings is an int32 array. Lines that aren't integers (probably the baudrate is wrong)
+        are skipped and counted in parseErrors. Lines don't have sequence numbers, hence the None."""
         readings = []
-        while not self.readingsQ.empty():
-            readings.append(self.readingsQ.get())
-        return readings
+        parseErrors = 0
+        for line in self.feed(data):
+            try:
+                readings.append(int(line))
+            except ValueError:
+                parseErrors += 1
+        return np.array(readings, dtype=np.int32), None, parseErrors
+
+    def clear(self):
+        self._buffer.clear()
+
+
+def _crc8Table(poly=0x07):
+    table = np.zeros(256, np.uint8)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xFF
+        table[i] = crc
+    return table
+
+
+# CRC-8 with polynomial x^8 + x^2 + x + 1, the same as crc8() in streamer.ino
+CRC8_TABLE = _crc8Table()
+
+
+class FrameDecoder(object):
+    """Decodes the binary protocol of streamer.ino (when built with BINARY_PROTOCOL).
+
+    Each reading is a FRAME_SIZE byte frame:
+        SYNC
+        3 bytes    the 24 bit HX711 reading, little endian two's complement
+        1 byte     a sequence number, which goes up by one every frame and wraps around
+        1 byte     CRC-8 of the 4 bytes before it
+
+    A whole chunk is decoded at once with numpy. Any SYNC byte followed by a
+    valid CRC is taken as a frame, so after garbage or a dropped byte we are
+    back in sync on the next good frame. Like LineFramer, an incomplete frame
+    at the end is kept for the next chunk."""
+
+    SYNC = 0xA5
+    FRAME_SIZE = 6
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # were the last bytes we threw away right at the end of what we had?
+        self._inGarbage = False
+
+    def feed(self, data):
+        """Add some bytes and return (readings, sequence numbers, parseErrors) of the frames that are now complete.
+
+        readings is an int32 array and sequence numbers a uint8 array. parseErrors counts
+        the stretches of bytes that had to be thrown away because they weren't valid frames."""
+        self._buffer += data
+        buf = np.frombuffer(bytes(self._buffer), np.uint8)
+        # the last place a complete frame could start
+        lastStart = len(buf) - self.FRAME_SIZE
+        starts = np.flatnonzero(buf[: max(lastStart + 1, 0)] == self.SYNC)
+        crc = CRC8_TABLE[buf[starts + 1]]
+        for k in range(2, self.FRAME_SIZE - 1):
+            crc = CRC8_TABLE[crc ^ buf[starts + k]]
+        starts = starts[crc == buf[starts + self.FRAME_SIZE - 1]]
+        if len(starts) > 1 and np.any(np.diff(starts) < self.FRAME_SIZE):
+            starts = self._nonOverlapping(starts)
+        end = starts[-1] + self.FRAME_SIZE if len(starts) else 0
+        # keep anything that could still be the start of a frame
+        cut = max(end, lastStart + 1)
+        del self._buffer[:cut]
+        parseErrors = self._countGarbage(starts, end, cut)
+        readings = (
+            buf[starts + 1].astype(np.int32)
+            | buf[starts + 2].astype(np.int32) << 8
+            | buf[starts + 3].astype(np.int32) << 16
+        )
+        # sign extend from 24 bits
+        readings = (readings ^ 0x800000) - 0x800000
+        return readings, buf[starts + 4], parseErrors
+
+    def _countGarbage(self, starts, end, cut):
+        """Count the stretches of bytes before cut that aren't in a frame, not counting
+        a stretch that carries on from the garbage at the end of the last chunk"""
+        if len(starts) == 0:
+            if cut == 0:
+                return 0
+            count = 0 if self._inGarbage else 1
+            self._inGarbage = True
+            return count
+        previousEnds = np.concatenate(([0], starts[:-1] + self.FRAME_SIZE))
+        gaps = starts != previousEnds
+        count = int(np.count_nonzero(gaps))
+        if gaps[0] and self._inGarbage:
+            count -= 1
+        self._inGarbage = cut > end
+        return count + self._inGarbage
+
+    def _nonOverlapping(self, starts):
+        """A SYNC byte inside a frame can pass the CRC by chance. Such a fake frame
+        overlaps the real one before it, so keep the earliest of any overlapping frames."""
+        kept = [starts[0]]
+        for start in starts[1:]:
+            if start >= kept[-1] + self.FRAME_SIZE:
+                kept.append(start)
+        return np.array(kept)
+
+    def decode(self, data):
+        """The same as feed(), so it can be used just like LineFramer.decode()"""
+        return self.feed(data)
+
+    def clear(self):
+        self._buffer.clear()
+        self._inGarbage = False
+
+
+def encodeFrames(readings, sequenceNumbers):
+    """Return the bytes of the frames of readings, the inverse of FrameDecoder"""
+    readings = np.asarray(readings, dtype=np.int32)
+    frames = np.empty((len(readings), FrameDecoder.FRAME_SIZE), np.uint8)
+    frames[:, 0] = FrameDecoder.SYNC
+    for k in range(3):
+        frames[:, 1 + k] = (readings >> (8 * k)) & 0xFF
+    frames[:, 4] = np.asarray(sequenceNumbers) & 0xFF
+    crc = CRC8_TABLE[frames[:, 1]]
+    for k in range(2, 5):
+        crc = CRC8_TABLE[crc ^ frames[:, k]]
+    frames[:, 5] = crc
+    return frames.tobytes()
+
+
+# "ascii" is a CRLF terminated decimal number per reading, decoded by LineFramer.
+# "binary" is the frames decoded by FrameDecoder.
+PROTOCOLS = ("ascii", "binary")
+
+
+class LinkStats(object):
+    """Counts what happened on the link to a scale.
+
+    The counts live in shared memory, so the reader process keeps them up to date
+    and the Scale in the main process can read them any time.
+        received: readings that made it through (duplicates not included)
+        missing: readings that never arrived, going by the gaps in the sequence numbers
+        duplicates: readings that arrived more than once, which are dropped
+        parseErrors: lines or stretches of bytes that couldn't be decoded
+    Only the binary protocol has sequence numbers, so otherwise missing and duplicates stay 0.
+    Sequence numbers are only 8 bits, so a gap of 256 or more readings is undercounted."""
+
+    FIELDS = ("received", "missing", "duplicates", "parseErrors")
+
+    def __init__(self):
+        self._counts = multiprocessing.RawArray("q", len(self.FIELDS))
+        # only used by the reader process
+        self._lastSequenceNumber = None
+        self._index = 0
+
+    def restart(self):
+        """Forget the last sequence number, eg after reconnecting, since we can't tell how many went by"""
+        self._lastSequenceNumber = None
+
+    def count(self, readings, sequenceNumbers, parseErrors):
+        """Count a batch of decoded readings and return (readings, indices) without any duplicates.
+
+        indices is the index of each reading in everything the device has sent, counting the missing ones.
+        Without sequence numbers it's just how many readings we have received."""
+        counts = self._counts
+        counts[3] += parseErrors
+        if sequenceNumbers is None or len(sequenceNumbers) == 0:
+            steps = np.ones(len(readings), np.int64)
+        else:
+            sequenceNumbers = sequenceNumbers.astype(np.int64)
+            previous = np.empty(len(sequenceNumbers), np.int64)
+            previous[1:] = sequenceNumbers[:-1]
+            if self._lastSequenceNumber is None:
+                # nothing to compare the first one with
+                previous[0] = sequenceNumbers[0] - 1
+            else:
+                previous[0] = self._lastSequenceNumber
+            self._lastSequenceNumber = sequenceNumbers[-1]
+            steps = (sequenceNumbers - previous) % 256
+            duplicate = steps == 0
+            steps = steps[~duplicate]
+            counts[1] += int(np.sum(steps - 1))
+            counts[2] += int(np.count_nonzero(duplicate))
+            readings = readings[~duplicate]
+        counts[0] += len(readings)
+        indices = self._index + np.cumsum(steps)
+        if len(indices):
+            self._index = int(indices[-1])
+        return readings, indices
+
+    def asDict(self):
+        """The counts by name, plus "dropRate", the fraction of readings that went missing"""
+        result = dict(zip(self.FIELDS, self._counts[:]))
+        sent = result["received"] + result["missing"]
+        result["dropRate"] = result["missing"] / sent if sent else 0.0
+        return result
+
+
+def makeDecoder(protocol, maxLineLength):
+    """Return a LineFramer or FrameDecoder for protocol, one of PROTOCOLS"""
+    if protocol not in PROTOCOLS:
+        raise ValueError("protocol must be one of {}".format(PROTOCOLS))
+    if protocol == "ascii":
+        return LineFramer(maxLineLength)
+    return FrameDecoder()
 
 
 class SerialReader(multiprocessing.Process):
@@ -194,24 +801,28 @@ class SerialReader(multiprocessing.Process):
     LINK_TIMEOUT = 5
     READ_TIMEOUT = 1
 
+    POLL_INTERVAL = 0.01
+
     MAX_PACKET_SIZE = 20
 
-    def __init__(self, portname, baudrate, readingsQ, commandQ):
+    def __init__(self, portname, baudrate, ring, commandQ, stats, protocol="ascii"):
         super(SerialReader, self).__init__()
         self.daemon = True
 
         self.portname = portname
         self._baudrate = baudrate
-        self.readingsQ = readingsQ
+        self.ring = ring
         self.commandQ = commandQ
+        self.stats = stats
 
         self._ser = None
+        self._decoder = makeDecoder(protocol, self.MAX_PACKET_SIZE)
+        self._sender = BlockSender(ring)
         atexit.register(self.close)
 
     def run(self):
         self._openPort()
         self._waitForLink()
-        last = time.time()
         while self._ser.is_open:
             # print('going through loop')
             # check for updates from outside this thread
@@ -222,51 +833,33 @@ class SerialReader(multiprocessing.Process):
                     break
                 else:
                     setattr(self, cmd["attr"], cmd["val"])
-            # read a line or timeout and return empty string
-            line = self._readline()
-            if line:
-                try:
-                    reading = int(line)
-                except:
-                    # must have had trouble parsing. probably the baudrate is wrong, but we can ignore it
-                    continue
-
-                # Throw out the oldeast reading if the Q is full
-                while self.readingsQ.full():
-                    self.readingsQ.get()
-                pair = (time.time(), reading)
-                self.readingsQ.put(pair)
-            else:
+            # read everything that is waiting, or None if we timed out
+            data = self._read()
+            if data is None:
                 # we didn't read anything, must have timeout out
                 print("didn't read anything")
                 break
+            self._sender.add(*self.stats.count(*self._decoder.decode(data)))
+        self._sender.flush()
         self.close()
 
-    def _readline(self):
-        chars = []
-        for i in range(self.MAX_PACKET_SIZE):
+    def _read(self):
+        """Return all the bytes waiting on the port.
+
+        Returns None if nothing arrives within READ_TIMEOUT or the port has a problem."""
+        deadline = time.time() + self.READ_TIMEOUT
+        while True:
             try:
-                c = self._ser.read(1)
-            except serial.SerialException as e:
+                waiting = self._ser.in_waiting
+                if waiting:
+                    return self._ser.read(waiting)
+            except (OSError, serial.SerialException):
                 # probably some I/O problem such as disconnected USB serial
                 return None
-            if not c:
-                # timed out on read of individual byte
-                return None
-            chars.append(c)
-            # check last two characters
-            if chars[-2:] == [b"\r", b"\n"]:
-                # looks promising...
-                try:
-                    strs = [c.decode() for c in chars[:-2]]
-                    result = "".join(strs)
-                    return result
-                except:
-                    # problem parsing, must be some other problem
-                    return "error"
-            else:
-                # got end of line or there's a problem with baudrate so we never get eol
+            if time.time() > deadline:
                 return None
+            # let a few more bytes pile up so we grab them all in one read
+            time.sleep(self.POLL_INTERVAL)
 
     def _openPort(self):
         # try to open the serial port
@@ -309,19 +902,33 @@ class SerialReader(multiprocessing.Process):
         self._baudrate = newval
         if self._ser:
             self._ser.baudrate = newval
+            # anything half-read at the old baudrate is garbage now
+            self._decoder.clear()
 
 
 class BluetoothScale(Scale):
 
-    MAX_BUFFERED_READINGS = 10000
+    # about 13 minutes at 80Hz
+    MAX_BUFFERED_READINGS = 2**16
 
-    def __init__(self, address, name):
+    def __init__(self, address, name, protocol="ascii"):
         self.address = address
         self.name = name
+        self.protocol = protocol
 
-        self.readingsQ = multiprocessing.Queue(self.MAX_BUFFERED_READINGS)
+        self._openRing(self.MAX_BUFFERED_READINGS)
         self.quitFlag = multiprocessing.Event()
-        self.reader = BluetoothReader(self.address, self.readingsQ, self.quitFlag)
+        # set by the reader while the link is up
+        self.connectedFlag = multiprocessing.Event()
+        self.linkStats = LinkStats()
+        self.reader = BluetoothReader(
+            self.address,
+            self.ring,
+            self.quitFlag,
+            self.linkStats,
+            protocol,
+            self.connectedFlag,
+        )
         self.reader.start()
 
     def __repr__(self):
@@ -343,109 +950,300 @@ class BluetoothScale(Scale):
     def isOpen(self):
         return self.reader.is_alive()
 
+    def isConnected(self):
+        """Whether the link is up right now. A scale can be open but reconnecting"""
+        return self.isOpen() and self.connectedFlag.is_set()
+
     def read(self):
-        readings = []
-        while not self.readingsQ.empty():
-            readings.append(self.readingsQ.get())
-        return readings
+        return readRing(self.ring)
+
+    def stats(self):
+        result = self.linkStats.asDict()
+        result["overruns"] = self.overruns
+        return result
 
 
 class BluetoothReader(multiprocessing.Process):
+    """Used by BluetoothScale to read from the scale in a different process.
+
+    If the link drops, we keep trying to reconnect, waiting MIN_BACKOFF seconds
+    and then twice as long after every failed try, up to MAX_BACKOFF. Once we're
+    back, a GAP reading is sent halfway through the outage, so the gap shows up
+    in the recording. After RECONNECT_TIMEOUT seconds without a connection we give up.
+    If we can't connect in the first place we give up straight away."""
 
     PORT = 1
     TIMEOUT = 10
     MAX_PACKET_SIZE = 10
+    RECV_SIZE = 1024
+    # in seconds
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 10
+    RECONNECT_TIMEOUT = 5 * 60
 
-    def __init__(self, address, readingQ, quitFlag):
+    def __init__(
+        self, address, ring, quitFlag, stats, protocol="ascii", connectedFlag=None
+    ):
         super(BluetoothReader, self).__init__()
         self.daemon = True
+        # set while the link is up, if given
+        self.connectedFlag = connectedFlag
 
         self._address = address
         self._sock = None
+        self._decoder = makeDecoder(protocol, self.MAX_PACKET_SIZE)
         atexit.register(self._close)
 
-        self.readingQ = readingQ
+        self.ring = ring
         self.quitFlag = quitFlag
+        self.stats = stats
+        self._sender = BlockSender(ring)
 
     def run(self):
+        # when the link went down, None if it's up (or was never up)
+        lostAt = None
+        backoff = self.MIN_BACKOFF
+        while not self.quitFlag.is_set():
+            try:
+                self._connect()
+            except IOError as e:
+                print(e)
+                self._close()
+                if lostAt is None or time.time() - lostAt > self.RECONNECT_TIMEOUT:
+                    print("giving up on bluetooth scale at address", self._address)
+                    break
+                self.quitFlag.wait(backoff)
+                backoff = min(2 * backoff, self.MAX_BACKOFF)
+                continue
+            backoff = self.MIN_BACKOFF
+            if lostAt is not None:
+                print("reconnected to bluetooth scale at address", self._address)
+                self._sender.markGap((lostAt + time.time()) / 2)
+                self._sender.flush()
+            if self.connectedFlag is not None:
+                self.connectedFlag.set()
+            self._stream()
+            if self.connectedFlag is not None:
+                self.connectedFlag.clear()
+            lostAt = time.time()
+            self._close()
+        self._sender.flush()
+        self._close()
+
+    def _connect(self):
         self._sock = bt.BluetoothSocket(bt.RFCOMM)
         self._sock.connect((self._address, self.PORT))
         self._sock.settimeout(self.TIMEOUT)
+        # whatever was half-read from before is garbage now,
+        # and we don't know how many sequence numbers went by
+        self._decoder.clear()
+        self.stats.restart()
+        self._sender.clock.reset()
+
+    def _stream(self):
+        """Read until we're told to quit or the link goes down"""
         while not self.quitFlag.is_set():
             try:
-                rawReading = self._readline()
-                reading = int(rawReading)
-                now = time.time()
-                self.readingQ.put((now, reading))
+                data = self._read()
             except IOError as e:
                 print(e)
                 break
-            except ValueError as e:
-                print(e)
-
-        self._close()
-
-    def _readline(self):
-        result = ""
-        for i in range(self.MAX_PACKET_SIZE):
-            byte = self._sock.recv(1)
-            result += byte
-            if result.endswith("\r\n"):
-                return result[:-2]
-        raise IOError(
-            "lost connection with bluetooth scale at address %s"
-            % str(self._sock.getsockname())
-        )
+            self._sender.add(*self.stats.count(*self._decoder.decode(data)))
+        self._sender.flush()
+
+    def _read(self):
+        """Return the bytes that have arrived, waiting for at most TIMEOUT"""
+        data = self._sock.recv(self.RECV_SIZE)
+        if not data:
+            raise IOError(
+                "lost connection with bluetooth scale at address %s" % self._address
+            )
+        return data
 
     def _close(self):
         if self._sock:
             self._sock.close()
+            self._sock = None
+
+
+def fallProfile(t, peak, riseTime, settle, ringFrequency, decayTime):
+    """The force of a synthetic fall at times t (an array, in seconds) after it starts.
+
+    Nothing before t = 0, then a smooth rise to exactly peak at t = riseTime,
+    then a ringing at ringFrequency Hz that decays with time constant
+    decayTime down to settle, the force of the weight just hanging there."""
+    t = np.asarray(t, dtype=float)
+    result = np.zeros(len(t))
+    rising = (t >= 0) & (t < riseTime)
+    result[rising] = peak * (1 - np.cos(np.pi * t[rising] / riseTime)) / 2
+    after = t >= riseTime
+    s = t[after] - riseTime
+    ringing = np.exp(-s / decayTime) * np.cos(2 * np.pi * ringFrequency * s)
+    result[after] = settle + (peak - settle) * ringing
+    return result
 
 
 class PhonyScale(Scale):
-    """Useful for generating random noise for testing GUI if an actual scale isn't present"""
-
-    SAMPLE_PERIOD = 1.0 / 80
-
-    def __init__(self):
-        self.last = time.time()
+    """Useful for generating random noise for testing GUI if an actual scale isn't present.
+
+    Makes sampleRate readings a second (it can keep up with tens of thousands),
+    each baseline plus Gaussian noise with standard deviation noise.
+    If fallInterval is given, there is also a synthetic fall (see fallProfile())
+    every fallInterval seconds, so analysis code can be checked against a known peak.
+    Every batch of readings is generated at once by numpy."""
+
+    # if read() isn't called for a while, only make up this many seconds of readings
+    MAX_BACKLOG = 5.0
+
+    def __init__(
+        self,
+        sampleRate=80,
+        noise=100,
+        baseline=0,
+        fallInterval=None,
+        peak=100000,
+        riseTime=0.05,
+        settle=20000,
+        ringFrequency=3,
+        decayTime=0.5,
+        seed=None,
+    ):
+        self.sampleRate = sampleRate
+        self.noise = noise
+        self.baseline = baseline
+        self.fallInterval = fallInterval
+        self.fall = dict(
+            peak=peak,
+            riseTime=riseTime,
+            settle=settle,
+            ringFrequency=ringFrequency,
+            decayTime=decayTime,
+        )
         self.baudrate = 9600
+        self._rng = np.random.default_rng(seed)
+        self._start = time.time()
+        # index of the next reading, reading i is at self._start + i / sampleRate
+        self._next = 0
+        self._delivered = 0
 
     def __str__(self):
         return "Phony Scale"
 
-    def isOpen():
+    def isOpen(self):
         return True
 
     def read(self):
-        now = time.time()
-        readings = []
-        for timestamp in self.frange(self.last, now, self.SAMPLE_PERIOD):
-            val = int(rand.normal() * 100)
-            readings.append((timestamp, val))
-        return readings
+        elapsed = time.time() - self._start
+        last = int(elapsed * self.sampleRate)
+        self._next = max(self._next, last - int(self.MAX_BACKLOG * self.sampleRate))
+        t = np.arange(self._next, last + 1) / self.sampleRate
+        self._next = last + 1
+        values = self.baseline + self.noise * self._rng.standard_normal(len(t))
+        if self.fallInterval:
+            # the first fall is after one fallInterval
+            sinceFall = np.where(t >= self.fallInterval, t % self.fallInterval, -1.0)
+            values += fallProfile(sinceFall, **self.fall)
+        self._delivered += len(t)
+        return self._start + t, values
 
     def close(self):
         pass
 
-    @staticmethod
-    def frange(start, stop=None, inc=None):
-        """A range() method for floats"""
-        if stop is None:
-            stop = start
-            start = 0.0
-        if inc is None:
-            inc = 1.0
-        i = 1
-        result = start
-
-        def shouldContinue(current, cutoff):
-            if inc > 0:
-                return current < cutoff
-            else:
-                return current > cutoff
+    def stats(self):
+        result = dict.fromkeys(LinkStats.FIELDS, 0)
+        result.update(received=self._delivered, dropRate=0.0, overruns=0)
+        return result
+
+
+def positiveFloat(text):
+    """An argparse type for numbers that must be positive, like ReplayScale's speed"""
+    try:
+        x = float(text)
+    except ValueError:
+        x = None
+    if x is None or not x > 0:
+        raise argparse.ArgumentTypeError("{!r} isn't a positive number".format(text))
+    return x
+
+
+class ReplayScale(Scale):
+    """Plays back a recording (.csv or .boa) through read(), as if it were a scale.
+
+    speed is how many times faster than real time to play it, with the timestamps
+    squeezed to match, or None to play it as fast as read() is called, MAX_READ
+    readings at a time, with the timestamps spaced as they were recorded.
+    Either way the recording starts when the ReplayScale is made.
+    If loop is True it starts over at the end, otherwise it closes.
+    For a recording of several scales, channel says which one to play."""
+
+    MAX_READ = 10000
+
+    def __init__(self, filename, speed=1.0, loop=False, channel=0):
+        if speed is not None and not speed > 0:
+            raise ValueError("speed must be positive, or None")
+        self.filename = str(filename)
+        self.speed = speed
+        self.loop = loop
+        times, values, header = recording.load(filename)
+        if values.ndim == 2:
+            values = values[channel]
+        times = np.asarray(times, dtype=float)
+        # seconds since the start of the recording
+        self._times = times - times[0] if len(times) else times
+        self._values = np.asarray(values, dtype=float)
+        # how long one lap is, including the gap before starting over
+        if len(times) > 1:
+            self._duration = self._times[-1] + np.median(np.diff(self._times))
+        else:
+            self._duration = 1.0
+        self._start = time.time()
+        self._pos = 0
+        self._lap = 0
+        self._delivered = 0
+        # there's nothing to play (and looping over nothing would never end)
+        self._closed = len(self._times) == 0
+        if self._closed:
+            print(self.filename, "has no readings to replay")
 
-        while shouldContinue(result, stop):
-            yield result
-            result = start + i * inc
-            i += 1
+    def __str__(self):
+        return "Replay of " + os.path.basename(self.filename)
+
+    def isOpen(self):
+        return not self._closed and (self.loop or self._pos < len(self._times))
+
+    def close(self):
+        self._closed = True
+
+    def read(self):
+        if not self.isOpen():
+            return np.empty(0), np.empty(0)
+        if self.speed is None:
+            now = np.inf
+        else:
+            # how far into the recording we should be
+            now = (time.time() - self._start) * self.speed
+        times = []
+        values = []
+        remaining = self.MAX_READ if self.speed is None else len(self._times)
+        while remaining > 0:
+            lapStart = self._lap * self._duration
+            end = np.searchsorted(self._times, now - lapStart, side="right")
+            end = min(end, self._pos + remaining)
+            times.append(self._times[self._pos : end] + lapStart)
+            values.append(self._values[self._pos : end])
+            remaining -= end - self._pos
+            self._pos = end
+            if self._pos < len(self._times) or not self.loop:
+                break
+            self._pos = 0
+            self._lap += 1
+        times = np.concatenate(times)
+        self._delivered += len(times)
+        if self.speed is not None:
+            times /= self.speed
+        return self._start + times, np.concatenate(values)
+
+    def stats(self):
+        result = dict.fromkeys(LinkStats.FIELDS, 0)
+        result.update(received=self._delivered, dropRate=0.0, overruns=0)
+        return result
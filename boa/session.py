@@ -0,0 +1,158 @@
+"""Recording from several scales at once.
+
+For tests like anchor load sharing we need three or four scales recorded
+at the same time. A Session reads every one of its scales, keeps a
+SampleStore per scale, and can line them all up on a common time grid so
+they can be saved as one multi-channel recording.
+"""
+import numpy as np
+
+import recording
+from samples import Downsampler, SampleStore
+
+
+class Channel(object):
+    """One scale in a Session, and the downsampled samples read from it"""
+
+    def __init__(self, scale, sampleInterval, maxlen):
+        self.scale = scale
+        self.name = str(scale)
+        self.data = SampleStore(maxlen)
+        self.downsampler = Downsampler(sampleInterval)
+        # once the scale goes away we keep its samples, but stop reading it
+        self.stopped = False
+
+    def flush(self):
+        """Add the sample the downsampler is holding back"""
+        self.data.extend(*self.downsampler.flush())
+
+
+class Session(object):
+    """Reads from any number of scales, keeping the samples of each in its own channel.
+
+    Samples are downsampled to sampleRate, and only final samples are stored,
+    so a channel lags its scale by about one sample."""
+
+    def __init__(self, sampleRate, maxlen=100000):
+        self.sampleRate = sampleRate
+        self.maxlen = maxlen
+        # in the order they were added
+        self.channels = []
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __contains__(self, scale):
+        """Whether scale is being read"""
+        return any(c.scale is scale and not c.stopped for c in self.channels)
+
+    @property
+    def names(self):
+        return [c.name for c in self.channels]
+
+    def addScale(self, scale):
+        """Start reading from scale.
+
+        If a scale of the same name went away earlier (eg its cable was bumped),
+        its channel carries on with this one"""
+        if scale in self:
+            return
+        for c in self.channels:
+            if c.stopped and c.name == str(scale):
+                c.scale = scale
+                c.stopped = False
+                return
+        self.channels.append(Channel(scale, 1.0 / self.sampleRate, self.maxlen))
+
+    def stopScale(self, scale):
+        """Stop reading from scale, eg because it went away. Its samples are kept until clear() or removeAll()"""
+        for c in self.channels:
+            if c.scale is scale and not c.stopped:
+                c.flush()
+                c.stopped = True
+
+    def removeScale(self, scale):
+        """Stop reading from scale. Its samples are forgotten"""
+        self.channels = [c for c in self.channels if c.scale is not scale]
+
+    def removeAll(self):
+        self.channels = []
+
+    def setSampleRate(self, sampleRate):
+        self.sampleRate = sampleRate
+        for c in self.channels:
+            c.flush()
+            c.downsampler = Downsampler(1.0 / sampleRate)
+
+    def read(self):
+        """Read every scale and add the new samples to its channel.
+
+        Returns {scale: (times, values)} of the raw readings, for anyone else who wants them,
+        since once they're read they're gone from the scale."""
+        raw = {}
+        for c in self.channels:
+            if c.stopped:
+                continue
+            times, values = c.scale.read()
+            raw[c.scale] = times, values
+            c.data.extend(*c.downsampler.add(times, values))
+        return raw
+
+    def clear(self):
+        """Forget all the samples, and the channels of scales that went away"""
+        self.channels = [c for c in self.channels if not c.stopped]
+        for c in self.channels:
+            c.data.clear()
+            c.downsampler.flush()
+
+    def aligned(self, startTime=-np.inf, stopTime=np.inf):
+        """Return (times, values) of all the channels resampled onto one grid, with startTime <= time < stopTime.
+
+        times are multiples of the sample interval, and values has one row per channel.
+        Each channel is linearly interpolated onto the grid. Where a channel
+        has no samples (before it started, after it stopped, or a gap of more
+        than two samples) its value is nan."""
+        interval = 1.0 / self.sampleRate
+        spans = [c.data.between(startTime, stopTime) for c in self.channels]
+        spans = [(t, v) for t, v in spans if len(t)]
+        if not spans:
+            return np.empty(0), np.empty((len(self.channels), 0))
+        first = min(t[0] for t, v in spans)
+        last = max(t[-1] for t, v in spans)
+        grid = np.arange(np.ceil(first / interval), np.floor(last / interval) + 1)
+        grid *= interval
+        values = np.full((len(self.channels), len(grid)), np.nan)
+        for row, c in zip(values, self.channels):
+            times, vals = c.data.between(startTime, stopTime)
+            if len(times) == 0:
+                continue
+            row[:] = np.interp(grid, times, vals, left=np.nan, right=np.nan)
+            if len(times) > 1:
+                # don't interpolate across gaps
+                right = np.clip(np.searchsorted(times, grid), 1, len(times) - 1)
+                nearest = np.minimum(
+                    np.abs(grid - times[right - 1]), np.abs(times[right] - grid)
+                )
+                row[nearest > 1.01 * interval] = np.nan
+        return grid, values
+
+    def save(self, filename, startTime=-np.inf, stopTime=np.inf, **kwargs):
+        """Save all the channels as one recording, .boa or .csv going by the filename.
+
+        kwargs go to recording.saveBoa() (calibration, units) or saveCsv() (precision)"""
+        times, values = self.aligned(startTime, stopTime)
+        if len(times) == 0:
+            return
+        if str(filename).endswith(".boa"):
+            recording.saveBoa(
+                filename,
+                times,
+                values,
+                names=self.names,
+                sampleRate=self.sampleRate,
+                **kwargs
+            )
+        else:
+            recording.saveCsv(
+                filename, ["time"] + self.names, [times] + list(values), **kwargs
+            )